@@ -0,0 +1,263 @@
+"""End-to-end benchmark of the ingestion and question paths, fully offline.
+
+The stages run on synthetic Notion exports and Zendesk dumps of each size, with
+deterministic fake embeddings and a fake streaming LLM, so the numbers only
+measure our own code:
+
+    notion_load      read and chunk every page of the export (per page)
+    chunk_store      write the chunks to a chunk store and read their text back (per chunk, latency per batch read)
+    embed            embed and upsert the chunks into a local index, build the keyword index (per chunk, latency per batch)
+    zendesk_extract  extract the sections of every article and count their tokens (per article)
+    query            answer questions through the retriever and the QA chain (per question), checking
+                     that the conversation reaches the prompt
+
+Every stage runs in a fresh process, so its peak RSS is its own. The results
+are written as JSON, pass a previous file as --baseline to fail on regressions:
+
+    python ./benchmarks/bench_e2e.py --sizes 1000 10000 --fake-tokenizer
+    python ./benchmarks/bench_e2e.py --sizes 1000 --baseline ./.cache/benchmarks/e2e-20240101-120000.json
+"""
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "notion"))
+from synthetic import synthetic_export, synthetic_zendesk_dump, synthetic_questions
+
+STAGES = ("notion_load", "chunk_store", "embed", "zendesk_extract", "query")
+
+
+class TimedEmbeddings:
+    """Wraps an embeddings client to time every `embed_documents` call."""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.latencies = []
+
+    def embed_documents(self, texts):
+        started = time.perf_counter()
+        vectors = self.embeddings.embed_documents(texts)
+        self.latencies.append(time.perf_counter() - started)
+        return vectors
+
+
+def stage_notion_load(data_dir, args):
+    from notion_export import iter_markdown_files, load_pages
+
+    latencies, chunks = [], 0
+    for path in iter_markdown_files(os.path.join(data_dir, "notion")):
+        started = time.perf_counter()
+        for _, _, splits in load_pages([path], args.chunk_tokens, args.overlap_tokens):
+            chunks += len(splits)
+        latencies.append(time.perf_counter() - started)
+    return "page", len(latencies), latencies, {"chunks": chunks}
+
+
+def stage_chunk_store(data_dir, args):
+    from chunk_store import ChunkStore
+    from notion_export import iter_notion_chunks
+
+    chunks = list(iter_notion_chunks(os.path.join(data_dir, "notion"), processes=1,
+                                     max_tokens=args.chunk_tokens, overlap_tokens=args.overlap_tokens))
+    store = ChunkStore(os.path.join(data_dir, "chunks"))
+    started = time.perf_counter()
+    with store.writer(replace=True) as writer:
+        for offset in range(0, len(chunks), args.batch_size):
+            writer.write_documents(chunks[offset:offset + args.batch_size])
+    write_s = time.perf_counter() - started
+
+    latencies, rows = [], 0
+    batches = store.read(columns=["id", "text"], batch_size=args.batch_size)
+    while True:
+        started = time.perf_counter()
+        batch = next(batches, None)
+        if batch is None:
+            break
+        rows += len(batch.column("text").to_pylist())
+        latencies.append(time.perf_counter() - started)
+    # the latencies are per batch of `batch_size` chunks read
+    return "chunk", rows, latencies, {"latency_per": "batch", "write_s": round(write_s, 3)}
+
+
+def stage_embed(data_dir, args):
+    from chunk_store import ChunkStore
+    from fakes import FakeEmbeddings
+    from ingest import embed_and_upsert
+    from keyword_index import KeywordIndex
+    from local_index import LocalIndex
+    from notion_export import iter_notion_chunks
+
+    # the chunks are handed over by the chunk_store stage when it ran
+    store = ChunkStore(os.path.join(data_dir, "chunks"))
+    if len(store):
+        chunks = list(store.documents(batch_size=args.batch_size))
+    else:
+        chunks = list(iter_notion_chunks(os.path.join(data_dir, "notion"), processes=1,
+                                         max_tokens=args.chunk_tokens, overlap_tokens=args.overlap_tokens))
+    embeddings = TimedEmbeddings(FakeEmbeddings(args.dimension))
+    index = LocalIndex(os.path.join(data_dir, "index"))
+    embed_and_upsert(chunks, embeddings, index, batch_size=args.batch_size, max_workers=args.workers, progress=False)
+    index.save()
+    started = time.perf_counter()
+    keywords = KeywordIndex(os.path.join(data_dir, "keywords"))
+    keywords.add_documents(chunks)
+    keywords.save()
+    # the latencies are per batch of `batch_size` chunks
+    return "chunk", len(chunks), embeddings.latencies, {"latency_per": "batch", "keyword_index_s": round(time.perf_counter() - started, 3)}
+
+
+def stage_zendesk_extract(data_dir, args):
+    from index_zendesk import extract_html_content, count_content_tokens
+
+    latencies, rows = [], 0
+    with open(os.path.join(data_dir, "zendesk.jsonl"), "r", encoding="utf-8") as f:
+        for line in f:
+            article = json.loads(line)
+            started = time.perf_counter()
+            ids, contents, urls = extract_html_content(f"{article['category']} - {article['section']}", article["title"],
+                                                       article["body"], article["html_url"])
+            rows += len(count_content_tokens(ids, contents, urls))
+            latencies.append(time.perf_counter() - started)
+    return "article", len(latencies), latencies, {"rows": rows}
+
+
+def stage_query(data_dir, args):
+    from fakes import FakeEmbeddings, FakeStreamingChatModel
+    from keyword_index import KeywordIndex
+    from local_index import LocalIndex, LocalVectorStore
+    from qa import ask, build_qa_chain, build_retriever
+
+    vectordb = LocalVectorStore(FakeEmbeddings(args.dimension), LocalIndex.load(os.path.join(data_dir, "index")))
+    retriever = build_retriever(vectordb, k=3, keyword_index=KeywordIndex.load(os.path.join(data_dir, "keywords")),
+                                context_tokens=args.context_tokens, candidates=args.candidates)
+    llm = FakeStreamingChatModel(responses=["Open the Studio, check the mapping of the field and deploy the model again.\n"
+                                            "SOURCES: https://www.notion.so/madkudu/Runbook-0"], delay=args.llm_delay)
+    qa_chain = build_qa_chain(llm, retriever)
+    questions = synthetic_questions(args.queries + 1)
+    # the warm-up question comes with a conversation, which has to reach the LLM
+    summary = "The user could not deploy their model from the Studio after changing the mapping of a field."
+    ask(qa_chain, questions[0], chat_history=[("Which field?", "The industry field.")], summary=summary)
+    if summary not in llm.prompts[-1] or "Which field?" not in llm.prompts[-1]:
+        raise RuntimeError("the conversation is missing from the prompt sent to the LLM")
+
+    latencies = []
+    for question in questions[1:]:
+        started = time.perf_counter()
+        ask(qa_chain, question)
+        latencies.append(time.perf_counter() - started)
+    return "question", len(latencies), latencies, {}
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_stage(stage, size, data_dir, args):
+    """Runs a stage and summarizes it. This runs in a fresh process."""
+    if args.fake_tokenizer:
+        from fakes import FakeEncoding
+        from tokens import register_encoding
+        register_encoding("cl100k_base", FakeEncoding())
+    started = time.perf_counter()
+    unit, items, latencies, extra = globals()["stage_" + stage](data_dir, args)
+    elapsed = time.perf_counter() - started
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99]) if latencies else (0.0, 0.0, 0.0)
+    return {
+        "stage": stage, "size": size, "unit": unit, "items": items, "seconds": round(elapsed, 3),
+        "throughput": round(items / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3), "p99_ms": round(float(p99), 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1), **extra,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of `results` against `baseline`: throughput down or p95 up by more than `tolerance`."""
+    previous = {(result["stage"], result["size"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["stage"], result["size"]))
+        if before is None:
+            continue
+        if result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{result['stage']} @ {result['size']}: {result['throughput']} {result['unit']}/s, was {before['throughput']}")
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{result['stage']} @ {result['size']}: p95 {result['p95_ms']}ms, was {before['p95_ms']}ms")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000], help="how many Notion pages and Zendesk articles, e.g. 1000 10000 100000")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="the stages to run, embed has to run before query")
+    parser.add_argument("--queries", type=int, default=200, help="how many questions the query stage answers")
+    parser.add_argument("--dimension", type=int, default=1536, help="the size of the fake embeddings")
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=100, help="how many chunks to embed and upsert per call")
+    parser.add_argument("--workers", type=int, default=4, help="how many batches can be in flight at the same time")
+    parser.add_argument("--chunk-tokens", dest="chunk_tokens", type=int, default=400, help="the maximum size of a Notion chunk, in tokens")
+    parser.add_argument("--overlap-tokens", dest="overlap_tokens", type=int, default=50, help="the overlap of the Notion chunks, in tokens")
+    parser.add_argument("--context-tokens", dest="context_tokens", type=int, default=1500, help="how many tokens of chunks the context of a question has, 0 for the 3 best chunks as they are")
+    parser.add_argument("--candidates", type=int, default=20, help="how many chunks are fetched to be compressed into the context")
+    parser.add_argument("--llm-delay", dest="llm_delay", type=float, default=0.0, help="seconds the fake LLM waits before each word")
+    parser.add_argument("--fake-tokenizer", dest="fake_tokenizer", action="store_true", help="count words instead of tiktoken tokens, when the tiktoken encodings can't be downloaded")
+    parser.add_argument("--workdir", help="where to generate the synthetic data, a temporary directory by default")
+    parser.add_argument("--out", default=os.path.join(".cache", "benchmarks", time.strftime("e2e-%Y%m%d-%H%M%S.json")), help="where to write the results")
+    parser.add_argument("--baseline", help="the results of a previous run, fail when a stage regressed")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="how much worse than the baseline a stage can get, 0.2 = 20%%")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for size in args.sizes:
+            data_dir = os.path.join(workdir, str(size))
+            started = time.perf_counter()
+            synthetic_export(os.path.join(data_dir, "notion"), size)
+            synthetic_zendesk_dump(os.path.join(data_dir, "zendesk.jsonl"), size)
+            print(f"generated {size} Notion pages and Zendesk articles in {time.perf_counter() - started:.1f}s")
+            for stage in args.stages:
+                # a fresh process per stage, so the peak RSS is the stage's own
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    result = executor.submit(run_stage, stage, size, data_dir, args).result()
+                results.append(result)
+                print(f"{stage:>16} @ {size}: {result['items']} {result['unit']}s in {result['seconds']}s, "
+                      f"{result['throughput']} {result['unit']}/s, p50 {result['p50_ms']}ms, p95 {result['p95_ms']}ms, "
+                      f"p99 {result['p99_ms']}ms, peak RSS {result['peak_rss_mb']}MB")
+
+    report = {
+        "meta": {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "started": time.strftime("%Y-%m-%dT%H:%M:%S"), "args": vars(args)},
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    print(f"results written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"  regression: {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
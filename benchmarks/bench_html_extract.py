@@ -0,0 +1,103 @@
+"""Compares the single-pass HTML section extractor with the previous per-sibling one on a synthetic article.
+
+    python ./benchmarks/bench_html_extract.py --sections 500
+"""
+import os
+import sys
+import time
+import uuid
+from argparse import ArgumentParser
+
+import html2text
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "notion"))
+from index_zendesk import extract_html_content
+from synthetic import synthetic_article
+
+
+# The extractor as it was before the single-pass rewrite, kept here as the reference
+def legacy_extract_html_content(
+    title_prefix: str,
+    page_title: str,
+    html: str,
+    url: str
+):
+    nuuids, ncontents, nurls = [], [], []
+
+    soup = BeautifulSoup(html, 'html.parser')
+    headings = soup.find_all(["h1", "h2", "h3", "h4", "h5", "h6"])
+
+    prev_heading = []
+
+    # Iterate through all headings and subheadings
+    for h in headings:
+        # Extract the heading text and remove HTML
+        heading = html2text.html2text(str(h)).strip()
+
+        # Initialize the content list
+        content = []
+
+        # Find the next heading or subheading
+        next_h = h.find_next(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+
+        actual_heading = heading.lstrip('#').lstrip(' ')
+
+        # Iterate through all siblings until the next heading or subheading is reached
+        for sibling in h.next_siblings:
+            if sibling == next_h:
+                break
+
+            # If the sibling is a tag, extract the text and remove HTML
+            if sibling.name:
+                para = html2text.html2text(str(sibling)).strip()
+                if len(para) > 0:
+                    content.append(para)
+
+        # If there are content entries, join them all together, clean up for utf-8 and write the row
+        if len(content) > 0:
+            content = "".join(content).replace("\n", "").encode('utf-8').decode('utf-8')
+
+            # If there are headings above this one without content, we concat them here
+            if len(prev_heading) > 0:
+                full_heading = " - ".join(prev_heading) + " - " + actual_heading
+            else:
+                full_heading = actual_heading
+
+            title = f"{title_prefix} - {page_title}"
+            # Store the extracted title, heading, content
+            row_uuid = str(uuid.uuid4())
+            nuuids.append(row_uuid)
+            ncontents.append(f"{title} - {full_heading} - {content}")
+            nurls.append(url)
+            prev_heading = []
+        else:
+            # Otherwise, we store this heading to append to the next sibling with content
+            prev_heading.append(actual_heading)
+
+    # Return the 3 arrays of titles, headings and content
+    return (nuuids, ncontents, nurls)
+
+
+def best_of(function, repeat, *args):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--sections", type=int, default=500, help="how many headings in the synthetic article")
+    parser.add_argument("--repeat", type=int, default=3, help="how many runs per extractor, the best one is reported")
+    args = parser.parse_args()
+
+    html = synthetic_article(args.sections)
+    print(f"synthetic article: {args.sections} sections, {len(html) / 1024:.0f}KB of HTML")
+    legacy_time, (_, legacy_rows, _) = best_of(legacy_extract_html_content, args.repeat, "Category", "Article", html, "url")
+    single_time, (_, rows, _) = best_of(extract_html_content, args.repeat, "Category", "Article", html, "url")
+    print(f"per-sibling extractor: {legacy_time * 1000:.0f}ms, {len(legacy_rows)} rows")
+    print(f"single-pass extractor: {single_time * 1000:.0f}ms, {len(rows)} rows")
+    print(f"speedup: {legacy_time / single_time:.1f}x")
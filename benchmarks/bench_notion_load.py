@@ -0,0 +1,43 @@
+"""Measures how fast a Notion export is read and split, in a pool of processes or in a single one.
+
+    python ./benchmarks/bench_notion_load.py --pages 20000 --processes 1 8
+    python ./benchmarks/bench_notion_load.py --dir ./notion_data/support_runbook
+"""
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "notion"))
+from notion_export import iter_markdown_files, iter_notion_chunks
+from synthetic import synthetic_export
+
+
+def bench(notion_dir, processes):
+    files = sum(1 for _ in iter_markdown_files(notion_dir))
+    start = time.perf_counter()
+    chunks = sum(1 for _ in iter_notion_chunks(notion_dir, processes=processes))
+    elapsed = time.perf_counter() - start
+    print(f"processes={processes or os.cpu_count()}: {files} files, {chunks} chunks in {elapsed:.2f}s, "
+          f"{files / elapsed:.0f} files/s, {chunks / elapsed:.0f} chunks/s")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--dir", help="An existing Notion export, instead of a synthetic one")
+    parser.add_argument("--pages", type=int, default=5000, help="How many pages the synthetic export has")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 0], help="The pool sizes to compare, 0 for one process per CPU")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        notion_dir = args.dir
+        if notion_dir is None:
+            notion_dir = tmp
+            synthetic_export(notion_dir, args.pages)
+        for processes in args.processes:
+            bench(notion_dir, processes or None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Measures the cold-start time of the ingestion modules.
+
+Every sample imports the module in a fresh interpreter, so nothing is shared
+between samples. Importing must not touch the network nor load a tokenizer
+or a model, use --max-ms to fail when the median import time regresses:
+
+    python ./benchmarks/bench_startup.py --max-ms 500
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+NOTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "notion")
+
+
+def time_import(module, samples):
+    """Returns the wall time, in ms, of `samples` fresh interpreters importing `module`."""
+    baseline = measure("pass", samples)
+    timings = measure(f"import {module}", samples)
+    # remove the cost of starting the interpreter itself
+    return [max(t - statistics.median(baseline), 0.0) for t in timings]
+
+
+def measure(code, samples):
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=NOTION_DIR, check=True)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--modules", nargs="*", default=["index_zendesk"], help="the modules to import")
+    parser.add_argument("--samples", type=int, default=10, help="how many fresh interpreters to time per module")
+    parser.add_argument("--max-ms", dest="max_ms", type=float, default=None, help="fail when a median import time is above this")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        timings = time_import(module, args.samples)
+        median = statistics.median(timings)
+        print(f"import {module}: median {median:.0f}ms, min {min(timings):.0f}ms, max {max(timings):.0f}ms over {args.samples} runs")
+        if args.max_ms is not None and median > args.max_ms:
+            print(f"  regression: above the {args.max_ms:.0f}ms budget")
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,60 @@
+"""Deterministic synthetic data for the benchmarks: Notion exports, Zendesk help center articles and questions."""
+import json
+import os
+import random
+import uuid
+
+WORDS = ("account", "model", "score", "Salesforce", "HubSpot", "sync", "field", "segment", "lead", "error",
+         "deploy", "Studio", "mapping", "contact", "workspace", "the", "a", "to", "of", "and", "is", "when")
+
+
+def synthetic_export(root, pages, paragraphs=8, seed=0):
+    """Writes `pages` markdown pages named like a Notion export, 100 per directory."""
+    rng = random.Random(seed)
+    for i in range(pages):
+        directory = os.path.join(root, f"Support runbooks {i // 100:04d}")
+        os.makedirs(directory, exist_ok=True)
+        page_id = uuid.UUID(int=rng.getrandbits(128)).hex
+        lines = [f"# Runbook {i}", ""]
+        for p in range(paragraphs):
+            lines += [f"## Step {p}", " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120))), ""]
+        with open(os.path.join(directory, f"Runbook {i} {page_id}.md"), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+
+
+def synthetic_article(sections, paragraphs=5):
+    """Builds a long help center article: nested headings, paragraphs, lists, links and a few empty headings."""
+    parts = []
+    for i in range(sections):
+        level = 2 + i % 3
+        parts.append(f"<h{level}>Section {i} about <a href='https://example.com/{i}'>feature {i}</a></h{level}>")
+        if i % 10 == 9:
+            continue
+        for j in range(paragraphs):
+            parts.append(f"<p>Paragraph {j} of section {i}. To fix <strong>error {i}-{j}</strong>, open the settings "
+                         f"and check the <em>mapping</em> of the field <code>field_{j}</code>.</p>")
+        parts.append("<ul>" + "".join(f"<li>step {k}</li>" for k in range(4)) + "</ul>")
+    return "<h1>Synthetic article</h1>" + "".join(parts)
+
+
+def synthetic_zendesk_dump(path, articles, seed=0):
+    """Writes `articles` help center articles as JSON lines, shaped like the articles of the Zendesk API."""
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(articles):
+            article = {
+                "id": 360000000000 + i,
+                "title": f"Article {i} about {rng.choice(WORDS)}",
+                "category": f"Category {i % 7}",
+                "section": f"Section {i % 31}",
+                "html_url": f"https://support.example.com/hc/en-us/articles/{360000000000 + i}",
+                "body": synthetic_article(rng.randint(2, 12), paragraphs=rng.randint(1, 4)),
+            }
+            f.write(json.dumps(article) + "\n")
+
+
+def synthetic_questions(count, seed=0):
+    """Returns `count` support questions made of the same words as the synthetic pages."""
+    rng = random.Random(seed)
+    return [f"How do I fix the {rng.choice(WORDS)} {rng.choice(WORDS)} error when the {rng.choice(WORDS)} fails?"
+            for _ in range(count)]
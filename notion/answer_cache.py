@@ -0,0 +1,170 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from atomic_files import replacing
+
+
+def normalize_question(question):
+    """Lowercases a question and drops its punctuation and extra whitespace, so trivial variations match exactly."""
+    return " ".join(re.sub(r"[^\w\s]", " ", question.lower()).split())
+
+
+class AnswerCache:
+    """Caches the answers of the QA chain in front of it.
+
+    A question hits the cache when its normalized text was already answered, or
+    when its embedding is at least `threshold` similar (cosine) to the embedding of
+    a question that was. Entries expire after `ttl` seconds and the least recently
+    used ones are evicted past `max_entries`. When `version` (a function returning
+    the current version of the index) changes, the whole cache is invalidated,
+    since the answers may have changed with the content.
+    """
+
+    def __init__(self, embeddings=None, threshold=0.95, ttl=24 * 3600, max_entries=1000, version=None):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version = version
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._keys = []
+        self._current_version = version() if version else None
+        self._lock = threading.Lock()
+
+    def _check_version(self):
+        if self.version is None:
+            return
+        current = self.version()
+        if current != self._current_version:
+            self._current_version = current
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._matrix = None
+
+    def _expire(self):
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if now - entry["created"] > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def _embed(self, question):
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _nearest(self, vector):
+        """Returns the key of the most similar cached question and its similarity."""
+        if self._matrix is None:
+            self._keys = [key for key, entry in self._entries.items() if entry["vector"] is not None]
+            self._matrix = np.stack([self._entries[key]["vector"] for key in self._keys]) if self._keys else None
+        if self._matrix is None:
+            return None, 0.0
+        scores = self._matrix @ vector
+        best = int(np.argmax(scores))
+        return self._keys[best], float(scores[best])
+
+    def get(self, question):
+        """Returns the cached results of a question, or None. The results tell how they were found in 'cached'."""
+        key = normalize_question(question)
+        with self._lock:
+            self._check_version()
+            self._expire()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return dict(self._entries[key]["results"], question=question, cached="exact")
+        if self.embeddings is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        # embedding the question is done outside the lock, it may be an API call
+        vector = self._embed(question)
+        with self._lock:
+            nearest, similarity = self._nearest(vector)
+            if nearest is not None and similarity >= self.threshold and nearest in self._entries:
+                self._entries.move_to_end(nearest)
+                self.semantic_hits += 1
+                return dict(self._entries[nearest]["results"], question=question, cached="semantic")
+            self.misses += 1
+        return None
+
+    def put(self, question, results):
+        """Caches the answer and the sources of a question."""
+        vector = self._embed(question) if self.embeddings is not None else None
+        with self._lock:
+            self._entries[normalize_question(question)] = {
+                "results": {"answer": results["answer"], "sources": results["sources"]},
+                "vector": vector,
+                "created": time.time(),
+            }
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def save(self, path):
+        """Writes the entries to the `path` directory, e.g. to pre-warm the cache of the chatbot from a batch of questions."""
+        with self._lock:
+            entries = list(self._entries.items())
+        vectors = [entry["vector"] for _, entry in entries if entry["vector"] is not None]
+        rows = iter(range(len(vectors)))
+        saved = [{"key": key, "results": entry["results"], "created": entry["created"],
+                  "vector": next(rows) if entry["vector"] is not None else None} for key, entry in entries]
+        # the chatbot may be loading them
+        with replacing(os.path.join(path, "vectors.npy"), os.path.join(path, "entries.json")) as (vectors_path, entries_path):
+            with open(vectors_path, "wb") as f:
+                np.save(f, np.stack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32))
+            with open(entries_path, "w", encoding="utf-8") as f:
+                json.dump({"version": self._current_version, "entries": saved}, f)
+
+    def load(self, path):
+        """Adds the entries saved in the `path` directory, unless they were answered from another version of the index.
+        Returns how many were added."""
+        try:
+            with open(os.path.join(path, "entries.json"), "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            vectors = np.load(os.path.join(path, "vectors.npy"))
+        except FileNotFoundError:
+            return 0
+        with self._lock:
+            self._check_version()
+            if saved["version"] != self._current_version:
+                return 0
+            for entry in saved["entries"]:
+                vector = vectors[entry["vector"]] if entry["vector"] is not None and self.embeddings is not None else None
+                self._entries[entry["key"]] = {"results": entry["results"], "vector": vector, "created": entry["created"]}
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+            self._expire()
+            return len(saved["entries"])
+
+    def stats(self):
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        hits = self.exact_hits + self.semantic_hits
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,149 @@
+"""Answers a file of questions concurrently, with the same retriever and prompt as the chatbot, and writes the
+answers, their sources, latency and token usage as JSON lines, e.g. to check the answers after re-indexing.
+
+    python ./notion/ask_batch.py --questions questions.txt --concurrency 8
+    python ./notion/ask_batch.py --questions questions.txt --fake        # offline: fake LLM and embeddings, local index
+    python ./notion/ask_batch.py --questions questions.txt --warm-cache  # the chatbot starts with these answers cached
+"""
+import asyncio
+import json
+import os
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from dotenv import find_dotenv, load_dotenv
+
+from answer_cache import AnswerCache
+from backends import open_vectorstore, open_local_index, open_keyword_index, index_version, answer_cache_path
+from qa import MODEL_NAME, aask, build_llm, build_retriever, build_qa_chain, format_sources
+from streaming import TracingCallbackHandler
+from tokens import counter_for_model, register_encoding
+from tracing import configure, trace
+
+FAKE_ANSWER = "I don't know, you might need to create a runbook to address this specific question.\nSOURCES:"
+
+
+def read_questions(path):
+    """Reads the questions, one per line, or as JSON lines with a 'question' field. The other fields are kept in the output."""
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if path.endswith(".jsonl"):
+        return [json.loads(line) for line in lines]
+    return [{"question": line} for line in lines]
+
+
+def build_chain(index_name, model_name=MODEL_NAME, k=3, context_tokens=1500, candidates=20, fake=False, llm_delay=0.0):
+    """Returns the QA chain of the chatbot on an index and its embeddings. With `fake`, it runs offline: on the local
+    index, with fake embeddings and an LLM answering that it doesn't know."""
+    if fake:
+        from fakes import FakeEmbeddings, FakeEncoding, FakeStreamingChatModel
+        from local_index import LocalVectorStore
+
+        # count words as tokens, the tiktoken encodings may not be downloadable either
+        register_encoding("cl100k_base", FakeEncoding())
+        index = open_local_index(index_name)
+        vectordb = LocalVectorStore(FakeEmbeddings(index.dimension or 1536), index)
+        llm = FakeStreamingChatModel(responses=[FAKE_ANSWER], delay=llm_delay)
+    else:
+        from langchain.embeddings.openai import OpenAIEmbeddings
+        from embedding_cache import with_cache
+
+        load_dotenv(find_dotenv())
+        vectordb = open_vectorstore(index_name, with_cache(OpenAIEmbeddings()))
+        llm = build_llm(os.getenv("OPENAI_API_KEY"), model_name=model_name)
+    retriever = build_retriever(vectordb, k=k, keyword_index=open_keyword_index(index_name), context_tokens=context_tokens,
+                                candidates=candidates, token_counter=counter_for_model(model_name))
+    return build_qa_chain(llm, retriever, return_source_documents=True), vectordb.embeddings
+
+
+async def answer_question(qa_chain, item, semaphore, token_counter, answer_cache=None):
+    """Answers one question once the semaphore lets it, and returns its output line."""
+    async with semaphore:
+        started = time.perf_counter()
+        with trace("question", batch=True) as question_trace:
+            try:
+                results = await asyncio.to_thread(answer_cache.get, item["question"]) if answer_cache else None
+                if results is None:
+                    results = await aask(qa_chain, item["question"], callbacks=[TracingCallbackHandler(question_trace, token_counter)])
+                    if answer_cache is not None:
+                        await asyncio.to_thread(answer_cache.put, item["question"], results)
+            except Exception as error:
+                # one failing question doesn't stop the batch
+                results = {"error": f"{type(error).__name__}: {error}"}
+        output = {**item, "latency_ms": round((time.perf_counter() - started) * 1000, 3),
+                  "prompt_tokens": question_trace.counts.get("prompt_tokens"),
+                  "completion_tokens": question_trace.counts.get("completion_tokens"),
+                  "context_tokens": question_trace.counts.get("context_tokens"), "trace_id": question_trace.id}
+    if "error" in results:
+        return {**output, "error": results["error"]}
+    return {**output, "answer": results["answer"].strip(), "sources": format_sources(results["sources"]),
+            "retrieved": [doc.metadata.get("source") for doc in results.get("source_documents", [])],
+            "cached": results.get("cached")}
+
+
+async def answer_questions(qa_chain, items, concurrency=8, token_counter=None, answer_cache=None):
+    """Answers the questions with at most `concurrency` of them in flight, and returns their output lines in order."""
+    # the chain runs its blocking calls in the default executor, it needs a thread per question in flight
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*(answer_question(qa_chain, item, semaphore, token_counter, answer_cache) for item in items))
+
+
+def summarize(outputs, elapsed):
+    latencies = np.array([output["latency_ms"] for output in outputs]) if outputs else np.zeros(1)
+    p50, p95 = np.percentile(latencies, [50, 95])
+    errors = sum("error" in output for output in outputs)
+    cached = sum(bool(output.get("cached")) for output in outputs)
+    tokens = sum((output["prompt_tokens"] or 0) + (output["completion_tokens"] or 0) for output in outputs)
+    return (f"{len(outputs)} questions in {elapsed:.1f}s ({len(outputs) / elapsed:.1f}/s), p50 {p50:.0f}ms, p95 {p95:.0f}ms, "
+            f"{tokens} tokens, {cached} answered from the cache, {errors} errors")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--questions", required=True, help="A file with a question per line, or JSON lines with a 'question' field")
+    parser.add_argument("--out", default="./.cache/ask_batch.jsonl", help="Where to write the answers, as JSON lines")
+    parser.add_argument("--concurrency", type=int, default=8, help="How many questions can be answered at the same time")
+    parser.add_argument("--index", default="notion-db-chatbot", help="The index to answer from")
+    parser.add_argument("--model", default=MODEL_NAME, help="The OpenAI chat model answering the questions")
+    parser.add_argument("-k", type=int, default=3, help="How many chunks are retrieved for a question, with --context-tokens 0")
+    parser.add_argument("--context-tokens", dest="context_tokens", type=int, default=1500, help="How many tokens of chunks the context of a question has, 0 to send the k best chunks as they are")
+    parser.add_argument("--candidates", type=int, default=20, help="How many chunks are fetched to be compressed into the context")
+    parser.add_argument("--fake", action="store_true", help="Run offline, with fake embeddings and LLM on the local index")
+    parser.add_argument("--llm-delay", dest="llm_delay", type=float, default=0.0, help="With --fake, seconds the fake LLM waits before each word")
+    parser.add_argument("--warm-cache", dest="warm_cache", action="store_true", help="Answer from the answer cache of the chatbot and save the new answers in it")
+    args = parser.parse_args()
+    if args.fake and args.warm_cache:
+        parser.error("the fake answers can't warm the cache of the chatbot")
+
+    # every question is traced to ./.cache/traces.jsonl, the metrics go to ./.cache/metrics/ask_batch.prom
+    configure("ask_batch")
+    items = read_questions(args.questions)
+    qa_chain, embeddings = build_chain(args.index, model_name=args.model, k=args.k, context_tokens=args.context_tokens,
+                                       candidates=args.candidates, fake=args.fake, llm_delay=args.llm_delay)
+    answer_cache = None
+    if args.warm_cache:
+        answer_cache = AnswerCache(embeddings, version=lambda: index_version(args.index))
+        print(f"{answer_cache.load(answer_cache_path(args.index))} answers already cached")
+
+    print(f"Answering {len(items)} questions, {args.concurrency} at a time...")
+    started = time.perf_counter()
+    outputs = asyncio.run(answer_questions(qa_chain, items, concurrency=args.concurrency,
+                                           token_counter=counter_for_model(args.model), answer_cache=answer_cache))
+    elapsed = time.perf_counter() - started
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        for output in outputs:
+            f.write(json.dumps(output) + "\n")
+    if answer_cache is not None:
+        answer_cache.save(answer_cache_path(args.index))
+        print(f"the answer cache of the chatbot now has {answer_cache.stats()['entries']} answers")
+    print(summarize(outputs, elapsed))
+    print(f"the answers are in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
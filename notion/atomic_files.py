@@ -0,0 +1,29 @@
+"""Writes files next to their final path and swaps them in once complete, so readers never see half a file."""
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def replacing(*paths):
+    """Yields a temporary path next to each of `paths` to write it, and swaps them all in once the block is done.
+    When the block fails, the temporary files are removed and `paths` are left as they were."""
+    for path in paths:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_paths = [path + ".tmp" for path in paths]
+    try:
+        yield tmp_paths
+    except BaseException:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    for tmp_path, path in zip(tmp_paths, paths):
+        os.replace(tmp_path, path)
+
+
+@contextmanager
+def atomic_open(path, mode="w"):
+    """Opens a file to write in place of `path`, swapped in once it's closed."""
+    with replacing(path) as (tmp_path,):
+        with open(tmp_path, mode, encoding=None if "b" in mode else "utf-8") as f:
+            yield f
@@ -0,0 +1,105 @@
+import os
+import time
+
+from local_index import LocalIndex, LocalVectorStore, JOURNAL as LOCAL_INDEX_JOURNAL
+from keyword_index import KeywordIndex, JOURNAL
+
+
+def get_backend():
+    """Returns which vector database to use, set with the VECTOR_BACKEND environment variable: 'pinecone' (default) or 'local'."""
+    backend = os.getenv("VECTOR_BACKEND", "pinecone").lower()
+    if backend not in ("pinecone", "local"):
+        raise ValueError(f"Unknown VECTOR_BACKEND '{backend}', expected 'pinecone' or 'local'")
+    return backend
+
+
+def local_index_path(index_name):
+    """Returns where the local index is saved, under the LOCAL_INDEX_DIR environment variable (./.index by default)."""
+    return os.path.join(os.getenv("LOCAL_INDEX_DIR", "./.index"), index_name)
+
+
+def open_local_index(index_name, reset=False):
+    """Opens the local index, or starts an empty one when it doesn't exist yet or `reset` is set."""
+    path = local_index_path(index_name)
+    if reset:
+        # nor should the vectors journaled by an interrupted run come back
+        if os.path.exists(os.path.join(path, LOCAL_INDEX_JOURNAL)):
+            os.remove(os.path.join(path, LOCAL_INDEX_JOURNAL))
+        return LocalIndex(path)
+    return LocalIndex.open(path)
+
+
+def keyword_index_path(index_name):
+    """Returns where the keyword index of an index is saved, next to the local index whatever the backend."""
+    return local_index_path(index_name) + ".keywords"
+
+
+def open_keyword_index(index_name, reset=False):
+    """Opens the keyword index, or starts an empty one when it doesn't exist yet or `reset` is set."""
+    path = keyword_index_path(index_name)
+    if reset:
+        # nor should the chunks journaled by an interrupted run come back
+        if os.path.exists(os.path.join(path, JOURNAL)):
+            os.remove(os.path.join(path, JOURNAL))
+        return KeywordIndex(path)
+    return KeywordIndex.open(path)
+
+
+def index_version_path(index_name):
+    return os.path.join(os.getenv("INDEX_VERSION_DIR", "./.cache/index_versions"), index_name)
+
+
+def index_version(index_name):
+    """Returns the version of the index, which changes every time an ingestion script updates it (None if it never did)."""
+    try:
+        with open(index_version_path(index_name), "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def bump_index_version(index_name):
+    """Marks the index as updated, so the answers cached from its previous content are dropped."""
+    path = index_version_path(index_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(str(time.time_ns()))
+
+
+def answer_cache_path(index_name):
+    """Returns where the answers to questions on an index are saved to warm up the answer cache of the chatbot."""
+    return os.path.join(os.getenv("ANSWER_CACHE_DIR", "./.cache/answers"), index_name)
+
+
+def store_index(vectordb):
+    """Returns the index under a vector store, None for a store we don't know."""
+    # our local store keeps it in `index`, the langchain Pinecone store in `_index`
+    # (an empty local index is falsy, it has a length)
+    index = getattr(vectordb, "index", None)
+    return index if index is not None else getattr(vectordb, "_index", None)
+
+
+def index_vectors(vectordb):
+    """Returns a function reading the vectors of chunk ids from the local index of a vector store, as a dict of
+    id -> vector. None for a Pinecone index, where reading them would cost a round trip on every question."""
+    index = store_index(vectordb)
+    if not isinstance(index, LocalIndex):
+        return None
+
+    def fetch(ids):
+        return {id: vector["values"] for id, vector in index.fetch(ids)["vectors"].items()}
+    return fetch
+
+
+def open_vectorstore(index_name, embeddings):
+    """Returns the langchain vector store of the configured backend, connected to an existing index."""
+    if get_backend() == "local":
+        return LocalVectorStore(embeddings, open_local_index(index_name))
+
+    import pinecone
+    from langchain.vectorstores import Pinecone
+
+    # initialize connection to pinecone (get API key at app.pinecone.io)
+    # find your environment next to the api key in pinecone console
+    pinecone.Pinecone(api_key=os.getenv("PINECONE_API_KEY"), environment=os.getenv("PINECONE_ENV"))
+    return Pinecone.from_existing_index(index_name=index_name, embedding=embeddings)
@@ -0,0 +1,175 @@
+"""On-disk store of chunks in the Arrow IPC format, the handoff between the ingestion stages.
+
+A store is a directory of immutable part files. A writer appends a part, record
+batch by record batch, and the part shows up once the writer is closed. Readers
+memory-map the parts: the values are only paged in for the columns asked for,
+and nothing is copied until they're converted to Python objects.
+"""
+import json
+import os
+import time
+import uuid
+
+import pyarrow as pa
+
+from manifest import content_hash
+from tokens import get_counter
+
+SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("source", pa.string()),
+    ("url", pa.string()),
+    ("text", pa.string()),
+    ("tokens", pa.int32()),
+    ("hash", pa.string()),
+    # the other metadata of the chunk, as JSON
+    ("metadata", pa.string()),
+])
+# the metadata of a Document that has its own column
+COLUMN_METADATA = ("id", "source", "url")
+
+
+class ChunkWriter:
+    """Appends chunks to a store as a new part, `batch_size` rows per record batch.
+
+    With `replace`, the parts that were in the store when the writer was opened
+    are removed once it's closed: readers see either the previous chunks or the
+    new ones, and the ones that already opened the previous parts keep reading them."""
+
+    def __init__(self, store, batch_size=10_000, replace=False):
+        self.store = store
+        self.batch_size = batch_size
+        self.replaced = store.parts() if replace else []
+        # parts sort in the order they were written
+        self.path = os.path.join(store.path, f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.arrow")
+        self._sink = pa.OSFile(self.path + ".tmp", "wb")
+        self._writer = pa.ipc.new_file(self._sink, SCHEMA)
+        self._columns = {name: [] for name in SCHEMA.names}
+        self.written = 0
+
+    def write(self, rows):
+        """Appends rows, dicts with the columns of the store. The `hash` of the text is computed when missing,
+        the `metadata` can be a dict."""
+        for row in rows:
+            for name in ("id", "source", "url", "text", "tokens"):
+                self._columns[name].append(row[name])
+            self._columns["hash"].append(row.get("hash") or content_hash(row["text"]))
+            metadata = row.get("metadata")
+            self._columns["metadata"].append(json.dumps(metadata) if isinstance(metadata, dict) else metadata)
+            if len(self._columns["id"]) >= self.batch_size:
+                self.flush()
+
+    def write_documents(self, docs, encoding="cl100k_base"):
+        """Appends Documents, their tokens counted with `encoding`."""
+        docs = list(docs)
+        tokens = get_counter(encoding).count_batch([doc.page_content for doc in docs])
+        self.write({
+            "id": doc.metadata["id"], "source": doc.metadata.get("source"),
+            "url": doc.metadata.get("url", doc.metadata.get("source")), "text": doc.page_content, "tokens": count,
+            "metadata": {key: value for key, value in doc.metadata.items() if key not in COLUMN_METADATA},
+        } for doc, count in zip(docs, tokens))
+
+    def flush(self):
+        if not self._columns["id"]:
+            return
+        batch = pa.record_batch([pa.array(self._columns[field.name], type=field.type) for field in SCHEMA], schema=SCHEMA)
+        self._writer.write_batch(batch)
+        self.written += batch.num_rows
+        self._columns = {name: [] for name in SCHEMA.names}
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        self._sink.close()
+        os.replace(self.path + ".tmp", self.path)
+        for part in self.replaced:
+            os.remove(part)
+
+    def abort(self):
+        self._writer.close()
+        self._sink.close()
+        os.remove(self.path + ".tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ChunkStore:
+    """A directory of chunks with an id, a source, a url, a text, its number of tokens, its content hash and
+    its other metadata. Chunks are appended with `writer` and read, memory-mapped, with `read` or `documents`."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._index = None
+
+    def parts(self):
+        return sorted(os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(".arrow"))
+
+    def writer(self, batch_size=10_000, replace=False):
+        return ChunkWriter(self, batch_size=batch_size, replace=replace)
+
+    def append(self, rows):
+        with self.writer() as writer:
+            writer.write(rows)
+
+    def table(self, columns=None):
+        """Returns the chunks as a table backed by the memory-mapped parts, with the `columns` asked for only."""
+        tables = [pa.ipc.open_file(pa.memory_map(part)).read_all() for part in self.parts()]
+        table = pa.concat_tables(tables) if tables else SCHEMA.empty_table()
+        return table.select(columns) if columns else table
+
+    def read(self, columns=None, batch_size=1000, skip_rows=0):
+        """Yields the chunks as tables of `batch_size` rows, after the first `skip_rows` rows."""
+        table = self.table(columns)
+        for offset in range(skip_rows, table.num_rows, batch_size):
+            yield table.slice(offset, batch_size)
+
+    def documents(self, batch_size=1000):
+        """Yields the chunks as Documents, converting `batch_size` of them at a time."""
+        for batch in self.read(batch_size=batch_size):
+            yield from to_documents(batch)
+
+    def _lookup(self):
+        """Returns the table of the chunks and the index of their ids, as of the first lookup."""
+        if self._index is None:
+            table = self.table()
+            self._index = (table, {id: row for row, id in enumerate(table.column("id").to_pylist())})
+        return self._index
+
+    def get_documents(self, ids):
+        """Returns the Documents of the chunks with these ids. The chunks appended after the first lookup aren't found."""
+        table, rows = self._lookup()
+        return to_documents(table.take([rows[id] for id in ids]))
+
+    def __contains__(self, id):
+        return id in self._lookup()[1]
+
+    def fingerprint(self):
+        """Changes whenever a part is added or removed, the parts themselves never change."""
+        return ";".join(f"{os.path.basename(part)}:{os.path.getsize(part)}" for part in self.parts())
+
+    def clear(self):
+        for part in self.parts():
+            os.remove(part)
+        self._index = None
+
+    def __len__(self):
+        return sum(pa.ipc.open_file(pa.memory_map(part)).read_all().num_rows for part in self.parts())
+
+
+def to_documents(table):
+    """Converts a table of chunks to Documents."""
+    # langchain is only imported by the stages that need Documents, it is slow to import
+    from langchain_core.documents import Document
+
+    columns = table.to_pydict()
+    return [Document(page_content=text, metadata={**json.loads(metadata or "{}"), "id": id, "source": source, "url": url})
+            for id, source, url, text, metadata
+            in zip(columns["id"], columns["source"], columns["url"], columns["text"], columns["metadata"])]
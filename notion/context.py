@@ -0,0 +1,123 @@
+"""Assembles the context of a question: more chunks than needed are fetched, reranked with their embeddings,
+stripped of the sentences they repeat from each other and packed into a fixed token budget."""
+import re
+from typing import Any, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from keyword_index import document_key, reciprocal_rank_fusion
+from tracing import span, count
+
+SENTENCE_END = re.compile(r"(?<=[.!?]\s)|(?<=\n)")
+WORD_PATTERN = re.compile(r"\w+")
+# the "stuff" chain adds "Content: " and "Source: " lines around every chunk
+CHUNK_OVERHEAD_TOKENS = 6
+
+
+def split_sentences(text):
+    """Splits a text after its sentences and lines, the pieces keep their whitespace and join back into the text."""
+    return [piece for piece in SENTENCE_END.split(text) if piece]
+
+
+def shingles(words, size=3):
+    return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+class ContextCompressor(BaseRetriever):
+    """Fetches the candidate chunks of a question from `retriever` and returns the best of them, compressed to
+    `max_tokens` tokens altogether.
+
+    When the retriever is hybrid, the candidates are reranked by the reciprocal
+    rank fusion of their keyword search rank and of the similarity of their
+    embedding to the question's, which ranks all of them, the keyword hits the
+    vector search missed included. The embeddings of the candidates are read
+    from the local index by `vectors`, a function of their ids, they're never
+    embedded again. Otherwise the retrieval order stands. Then, best first,
+    their sentences of at least `min_words` words whose 3-word shingles are
+    `redundancy` or more already in the context are dropped, and the rest is added
+    while it fits in the budget, the last chunk cut at a sentence boundary.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    retriever: BaseRetriever
+    token_counter: Any
+    embeddings: Any = None
+    vectors: Any = None
+    max_tokens: int = 1500
+    redundancy: float = 0.8
+    min_words: int = 4
+    # a chunk cut shorter than this isn't worth its source line
+    min_chunk_tokens: int = 50
+    rrf_k: int = 60
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        candidates = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        with span("rerank", candidates=len(candidates)):
+            ranked = self.rerank(query, candidates)
+        with span("compress_context", candidates=len(candidates)) as attributes:
+            context, dropped = self.compress(ranked)
+            tokens = sum(doc.metadata["context_tokens"] for doc in context)
+            attributes.update(chunks=len(context), tokens=tokens, sentences_dropped=dropped)
+        count("context_tokens", tokens)
+        count("sentences_dropped", dropped)
+        return context
+
+    def rerank(self, query, docs):
+        # the vector search ranks its candidates by similarity already: only the keyword hits lack a vector rank,
+        # and fusing with the retrieval order would count the similarity twice
+        keyword_hits = sorted((doc for doc in docs if "keyword_rank" in doc.metadata), key=lambda doc: doc.metadata["keyword_rank"])
+        if self.embeddings is None or self.vectors is None or not keyword_hits:
+            return docs
+        found = self.vectors([doc.metadata["id"] for doc in docs if doc.metadata.get("id")])
+        ranked = [doc for doc in docs if doc.metadata.get("id") in found]
+        if not ranked:
+            return docs
+        # the retriever just embedded the question, the embeddings cache has it
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        vectors = np.asarray([found[doc.metadata["id"]] for doc in ranked], dtype=np.float32)
+        similarities = vectors @ query_vector / np.maximum(np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector), 1e-12)
+        by_similarity = [ranked[i] for i in np.argsort(-similarities, kind="stable")]
+        fused = reciprocal_rank_fusion([by_similarity, keyword_hits], k=self.rrf_k)
+        # the candidates with neither a vector nor a keyword rank come last, in their retrieval order
+        reranked = {document_key(doc) for doc in fused}
+        return fused + [doc for doc in docs if document_key(doc) not in reranked]
+
+    def compress(self, docs):
+        """Packs the chunks, best first, into the budget. Returns the compressed chunks and how many sentences were dropped."""
+        pieces = [split_sentences(doc.page_content) for doc in docs]
+        all_pieces = [piece for chunk in pieces for piece in chunk]
+        tokens = dict(zip(all_pieces, self.token_counter.count_batch(all_pieces)))
+        sources = [doc.metadata.get("source", "") for doc in docs]
+        tokens.update(zip(sources, self.token_counter.count_batch(sources)))
+
+        context, seen, used, dropped = [], set(), 0, 0
+        for doc, chunk, source in zip(docs, pieces, sources):
+            available = self.max_tokens - used - tokens[source] - CHUNK_OVERHEAD_TOKENS
+            if available < min(self.min_chunk_tokens, self.max_tokens // 4):
+                break
+            kept, kept_shingles, cost, cut = [], set(), 0, False
+            for piece in chunk:
+                words = WORD_PATTERN.findall(piece.lower())
+                piece_shingles = shingles(words)
+                if len(words) >= self.min_words and len(piece_shingles & seen) >= self.redundancy * len(piece_shingles):
+                    dropped += 1
+                    continue
+                if cost + tokens[piece] > available:
+                    cut = True
+                    break
+                kept.append(piece)
+                kept_shingles |= piece_shingles
+                cost += tokens[piece]
+            text = "".join(kept).strip()
+            # a chunk cut to a few sentences makes no sense on its own
+            if not text or (cut and cost < self.min_chunk_tokens):
+                continue
+            seen |= kept_shingles
+            cost += tokens[source] + CHUNK_OVERHEAD_TOKENS
+            used += cost
+            context.append(Document(page_content=text, metadata={**doc.metadata, "context_tokens": cost}))
+        return context, dropped
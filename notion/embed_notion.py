@@ -1,13 +1,19 @@
 import os
+import shutil
+from contextlib import nullcontext
 from dotenv import find_dotenv, load_dotenv
-from langchain_pinecone import PineconeVectorStore
-from langchain_community.document_loaders import NotionDirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
 from pinecone import Pinecone
-import tqdm
 import time
 from argparse import ArgumentParser
+from ingest import batched, embed_and_upsert
+from manifest import Manifest
+from notion_export import iter_notion_pages, iter_notion_chunks
+from near_duplicates import NearDuplicateFilter
+from chunk_store import ChunkStore
+from embedding_cache import with_cache
+from backends import get_backend, open_local_index, open_keyword_index, bump_index_version
+from tracing import trace, span, count
 
 
 def init(notion_dir_name):
@@ -27,15 +33,21 @@ def init(notion_dir_name):
 
     return pinecone_api_key, pinecone_env, notion_dir
 
-def load_notion_db(notion_dir):
-    """Loads the notion database from the specified directory and splits the documents into chunks of 500 characters with 0 overlap."""
-    loader = NotionDirectoryLoader(notion_dir)
-    data = loader.load()
+def load_notion_db(notion_dir, processes=None, max_tokens=400, overlap_tokens=50, chunk_store=None):
+    """Loads the notion database from the specified directory and splits the documents along their headings and lists into chunks of at most `max_tokens` tokens, in a pool of `processes` processes.
+    With a `chunk_store` path, the chunks are read from it when it has some and saved to it otherwise, so the export is only split once."""
+    store = ChunkStore(chunk_store) if chunk_store else None
+    if store is not None and len(store):
+        all_splits = list(store.documents())
+        print(f"we've read {len(all_splits)} chunks from {chunk_store}")
+        return all_splits
 
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=0)
-    all_splits = text_splitter.split_documents(data)
+    all_splits = list(iter_notion_chunks(notion_dir, processes=processes, max_tokens=max_tokens, overlap_tokens=overlap_tokens))
+    if store is not None:
+        with store.writer(replace=True) as writer:
+            writer.write_documents(all_splits)
 
-    print(f"we've split the documents into {len(all_splits)} chunks of 500 characters with 0 overlap")
+    print(f"we've split the documents into {len(all_splits)} chunks of at most {max_tokens} tokens with {overlap_tokens} tokens of overlap")
 
     return all_splits
 
@@ -62,35 +74,146 @@ def init_pinecone_index(index_name, pinecone_api_key, pinecone_env):
 
     return index
 
-def embed_splits_openai(all_splits, index_name):
-    """Embeds the splits using the OpenAI da Vinci model."""
+def embed_splits_openai(all_splits, index, batch_size=100, max_workers=4):
+    """Embeds the splits using the OpenAI embeddings model, each split exactly once, and upserts them into the index in batches."""
     
-    embeddings = OpenAIEmbeddings()
-
-    vectordb = PineconeVectorStore.from_documents(all_splits[:1], embeddings, index_name=index_name)
-
-    for i in tqdm.tqdm(range(1, len(all_splits))):
-        vectordb.add_documents(all_splits[:i])
-
-    return
+    embeddings = with_cache(OpenAIEmbeddings())
+
+    stats = embed_and_upsert(all_splits, embeddings, index, batch_size=batch_size, max_workers=max_workers)
+    print(embeddings.cache.report())
+
+    return stats
+
+def manifest_path(index_name, notion_dir_name):
+    """Returns where we keep track of what was embedded from a notion directory into an index."""
+    return os.path.join("./notion_data/.manifests", get_backend(), index_name, notion_dir_name + ".json")
+
+def chunk_store_path(index_name, notion_dir_name):
+    """Returns where the chunks of a notion directory are kept, next to its manifest so they're reset together."""
+    return os.path.splitext(manifest_path(index_name, notion_dir_name))[0] + ".chunks"
+
+def stored_pages(manifest, chunk_store):
+    """Returns the content hash of the pages of the manifest whose chunks are all in the chunk store."""
+    return {path: manifest.digest(path) for path in manifest.pages
+            if all(id in chunk_store for id in manifest.chunk_ids(path))}
+
+def sync_notion_pages(page_chunks, index, manifest, batch_size=100, max_workers=4, keywords=None, dedup=None, chunk_store=None):
+    """Embeds the new and changed pages and deletes the vectors of the changed and removed pages, then updates the manifest.
+
+    `page_chunks` yields the (path, content hash, chunks) of every page, e.g. `iter_notion_pages`.
+    The chunks of the new and changed pages stream into the embedding stage as they come.
+    The chunks of every page are saved to the `chunk_store`, if any, replacing the previous ones. The pages
+    yielded with None as their chunks weren't split again: their chunks are read from the store.
+    The `dedup` filter, if any, drops the chunks that are near-duplicates of a chunk
+    seen before, the chunks of the unchanged pages included. The manifest keeps what
+    they duplicate: once that chunk is changed or removed, they're embedded after all.
+    The `keywords` index, if any, gets the same chunks."""
+    seen = set()
+    changed = []
+    stale_ids = []
+    new_ids = set()
+    # the chunks of the unchanged pages that were skipped as near-duplicates
+    held = []
+
+    def changed_splits():
+        for path, digest, splits in page_chunks:
+            seen.add(path)
+            if splits is None:
+                splits = chunk_store.get_documents(manifest.chunk_ids(path))
+            if writer is not None:
+                writer.write_documents(splits)
+            if manifest.digest(path) == digest:
+                duplicates = manifest.duplicates(path)
+                held.extend((path, split) for split in splits if split.metadata["id"] in duplicates)
+                if dedup is not None:
+                    # the duplicates aren't in the index, no chunk should be dropped in their favor
+                    dedup.remember(split for split in splits if split.metadata["id"] not in duplicates)
+                continue
+            chunk_ids = [split.metadata["id"] for split in splits]
+            new_ids.update(chunk_ids)
+            stale_ids.extend(manifest.chunk_ids(path))
+            changed.append((path, digest, chunk_ids))
+            if dedup is not None:
+                splits = list(dedup.filter(splits))
+            if keywords is not None:
+                keywords.add_documents(splits)
+            yield from splits
+
+    # the new chunks replace the stored ones once they're all embedded
+    with chunk_store.writer(replace=True) if chunk_store is not None else nullcontext() as writer:
+        stats = embed_splits_openai(changed_splits(), index, batch_size=batch_size, max_workers=max_workers)
+    removed = [path for path in manifest.pages if path not in seen]
+    print(f"{len(changed)} new or changed pages ({stats.chunks} chunks), {len(removed)} removed pages, {len(seen) - len(changed)} unchanged pages")
+    stale_ids += [id for path in removed for id in manifest.chunk_ids(path)]
+
+    # the duplicates of the chunks of the previous version of the pages go through the filter again, the ones
+    # that duplicate nothing anymore are embedded
+    gone = set(stale_ids)
+    orphans = [(path, split) for path, split in held if manifest.duplicates(path)[split.metadata["id"]] in gone]
+    if orphans:
+        splits = [split for _, split in orphans]
+        if dedup is not None:
+            splits = list(dedup.filter(splits))
+        if keywords is not None:
+            keywords.add_documents(splits)
+        print(f"{len(orphans)} chunks duplicated chunks that changed or were removed, {len(splits)} of them are embedded now")
+        embed_splits_openai(splits, index, batch_size=batch_size, max_workers=max_workers)
+
+    # delete the vectors of the previous version of the pages (pinecone deletes up to 1000 ids per call),
+    # the ones that got a new version (same page id and position) were already overwritten by the upsert
+    stale_ids = [id for id in dict.fromkeys(stale_ids) if id not in new_ids]
+    with span("delete_stale", chunks=len(stale_ids)):
+        for ids in batched(stale_ids, 1000):
+            index.delete(ids=ids)
+        if keywords is not None:
+            keywords.delete(ids=stale_ids)
+    count("pages_changed", len(changed))
+    count("pages_removed", len(removed))
+    if dedup is not None:
+        print(dedup.report())
+        count("near_duplicates", len(dedup.duplicates))
+
+    duplicate_of = dedup.duplicate_of() if dedup is not None else {}
+    for path, digest, chunk_ids in changed:
+        manifest.update(path, digest, chunk_ids, {id: duplicate_of[id] for id in chunk_ids if id in duplicate_of})
+    for path in dict.fromkeys(path for path, _ in orphans):
+        duplicates = {id: target for id, target in manifest.duplicates(path).items() if target not in gone}
+        duplicates.update({id: duplicate_of[id] for id in manifest.chunk_ids(path) if id in duplicate_of})
+        manifest.update(path, manifest.digest(path), manifest.chunk_ids(path), duplicates)
+    for path in removed:
+        manifest.remove(path)
+    manifest.save()
 
 # run our main function
 if __name__ == '__main__':
     # get arguments from the command line
     parser = ArgumentParser()
     parser.add_argument("-n", "--notion", dest="notion_dir_name", help="what notion directory do you want to embed", metavar="NOTION_DIR", default="support_runbook")
-    parser.add_argument("--insert", dest="insert", help="insert the embeddings into the index", action="store_true")
+    parser.add_argument("--insert", "--incremental", dest="insert", help="insert the embeddings into the existing index, only the pages that are new or changed since the last run get embedded", action="store_true")
+    parser.add_argument("--batch-size", dest="batch_size", help="how many chunks to embed and upsert per API call", type=int, default=100)
+    parser.add_argument("--workers", dest="workers", help="how many batches can be in flight at the same time", type=int, default=4)
+    parser.add_argument("--chunk-tokens", dest="chunk_tokens", help="the maximum size of a chunk, in tokens", type=int, default=400)
+    parser.add_argument("--overlap-tokens", dest="overlap_tokens", help="how many tokens of a section a chunk repeats from the previous one", type=int, default=50)
+    parser.add_argument("--processes", dest="processes", help="how many processes read and split the pages, one per CPU by default", type=int, default=None)
+    parser.add_argument("--dedup-threshold", dest="dedup_threshold", help="skip the chunks whose words overlap this much with a chunk seen before, 0 to embed them all", type=float, default=0.9)
+    parser.add_argument("--dedup-report", dest="dedup_report", help="where to write which chunks were skipped as near-duplicates of which", default="./.cache/near_duplicates/embed_notion.jsonl")
     args = parser.parse_args()
     notion_dir_name = args.notion_dir_name
     insert = args.insert | False
     index_name = 'notion-db-chatbot'
     print("Ok let's go!")
     pinecone_api_key, pinecone_env, notion_dir = init(notion_dir_name)
-    print("Split the documents into chunks of 500 characters with 0 overlap.")
-    all_splits = load_notion_db(notion_dir)
-    if insert == False:
+    if get_backend() == "local":
+        index = open_local_index(index_name, reset=not insert)
+        if not insert:
+            shutil.rmtree(os.path.dirname(manifest_path(index_name, notion_dir_name)), ignore_errors=True)
+        print("we've opened the local index and here is it's description")
+        print(index.describe_index_stats())
+    elif insert == False:
         print("Initializing the pinecone index...")
         index = init_pinecone_index(index_name, pinecone_api_key, pinecone_env)
+        # the index is empty, so is everything we remembered about it
+        shutil.rmtree(os.path.dirname(manifest_path(index_name, notion_dir_name)), ignore_errors=True)
         print("we've created an index and here is it's description") 
         print(index.describe_index_stats())
     else:
@@ -98,7 +221,27 @@ if __name__ == '__main__':
         index = pinecone.Index(index_name)
         print("we've loaded an existing index and here is it's description")
         print(index.describe_index_stats())
-    print("let's embed the splits into the index, this might take some time and will cost you $")
-    embed_splits_openai(all_splits, index_name)
+    # the keyword index is rebuilt along with the vectors, whatever the backend
+    keywords = open_keyword_index(index_name, reset=not insert)
+    manifest = Manifest(manifest_path(index_name, notion_dir_name))
+    # the pages that didn't change since the previous run aren't split again, their chunks are read from the store
+    chunk_store = ChunkStore(chunk_store_path(index_name, notion_dir_name))
+    pages = iter_notion_pages(notion_dir, processes=args.processes, max_tokens=args.chunk_tokens, overlap_tokens=args.overlap_tokens,
+                              known=stored_pages(manifest, chunk_store))
+    dedup = NearDuplicateFilter(threshold=args.dedup_threshold) if args.dedup_threshold > 0 else None
+    print("let's embed the new and changed pages into the index, this might take some time and will cost you $")
+    # the run is traced to ./.cache/traces.jsonl, its metrics go to ./.cache/metrics/embed_notion.prom
+    with trace("embed_notion", notion_dir=notion_dir_name, insert=insert, backend=get_backend()):
+        sync_notion_pages(pages, index, manifest, batch_size=args.batch_size, max_workers=args.workers, keywords=keywords,
+                          dedup=dedup, chunk_store=chunk_store)
+        with span("save"):
+            if get_backend() == "local":
+                index.save()
+            keywords.save()
+    print(f"the keyword index has {len(keywords)} chunks")
+    if dedup is not None:
+        dedup.write_report(args.dedup_report)
+        print(f"the near-duplicates are listed in {args.dedup_report}")
+    bump_index_version(index_name)
     print("... and we're done! here is the index description again")
     print(index.describe_index_stats())
\ No newline at end of file
@@ -1,69 +1,268 @@
 import os
-from dotenv import load_dotenv
-import pinecone
-import openai
-import pandas as pd
+import json
+from argparse import ArgumentParser
+from dotenv import find_dotenv, load_dotenv
+from pinecone import Pinecone
 from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Pinecone
-import tqdm
-
-# Get variables from .env file
-load_dotenv()
-openai.api_key = os.getenv('OPEN_AI_API_KEY')
-# initialize connection to pinecone (get API key at app.pinecone.io)
-pinecone_api_key = os.getenv("PINECONE_API_KEY")
-# find your environment next to the api key in pinecone console
-pinecone_env = os.getenv("PINECONE_ENV")
+from atomic_files import atomic_open
+from embedding_cache import with_cache
+from backends import get_backend, open_local_index, open_keyword_index, bump_index_version
+from ingest import batched, embed_and_upsert
+from chunk_store import ChunkStore
+from manifest import Manifest
+from near_duplicates import NearDuplicateFilter
+from tracing import trace, span, count
 
 index_name = 'notion-db-chatbot'
 
-def load_content_dataframe():
-    df = pd.read_csv("./zendesk_data/contents.csv")
-    df = df.set_index(["id"])
-    print(f"{len(df)} rows in the data. Each row is an article that will be embedded.")
-    sample = df.sample(5)
-    print("Here is a sample (5 rows)", sample)
-    return df
 
-# Function that takes a row of a dataframe, a pinecone index and upserts the embedding to the index
-def upsert_embedding(row, index_name):
-    # Get the embedding for the row
-    embeddings = OpenAIEmbeddings()
+class Checkpoint:
+    """Remembers how many rows of a contents store were embedded, so a crashed run can resume where it stopped.
+
+    The checkpoint is tied to the parts of the store and to the `settings` of the
+    run: when index_zendesk rewrites the store, or the settings change, the job
+    starts over. It lives next to the manifest of the index, so it goes with it
+    when the index is reset."""
+
+    def __init__(self, path, content_path, settings=""):
+        self.path = path
+        self.fingerprint = f"{os.path.abspath(content_path)}:{ChunkStore(content_path).fingerprint()}:{settings}"
+        self.rows_done = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("fingerprint") == self.fingerprint:
+                self.rows_done = data.get("rows_done", 0)
+
+    def save(self, rows_done):
+        self.rows_done = rows_done
+        with atomic_open(self.path) as f:
+            json.dump({"fingerprint": self.fingerprint, "rows_done": rows_done}, f)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def read_content_chunks(content_path, chunksize=1000, skip_rows=0):
+    """Reads the contents store produced by index_zendesk in chunks of `chunksize` rows, skipping the first `skip_rows` rows.
+    Only the id, url and text columns are read, from the memory-mapped store."""
+    return ChunkStore(content_path).read(columns=["id", "url", "text"], batch_size=chunksize, skip_rows=skip_rows)
+
+
+def split_rows(rows, text_splitter):
+    """Splits all the rows of a chunk at once. Each split gets a stable id made of its row id and its position in the row."""
+    rows = [(row_id, url, text) for row_id, url, text in zip(*(column.to_pylist() for column in rows.columns)) if text]
+    all_splits = text_splitter.create_documents(
+        [text for _, _, text in rows],
+        metadatas=[{"source": url, "row_id": row_id} for row_id, url, _ in rows]
+    )
+    ordinals = {}
+    for split in all_splits:
+        row_id = split.metadata["row_id"]
+        ordinals[row_id] = ordinals.get(row_id, -1) + 1
+        split.metadata["id"] = f"{row_id}-{ordinals[row_id]}"
+    return all_splits
+
+
+def manifest_path(content_path):
+    """Returns where we keep track of the rows of a contents store embedded into the index, next to the manifests
+    of embed_notion, which are reset along with the index."""
+    name = "zendesk." + os.path.basename(os.path.normpath(content_path)) + ".json"
+    return os.path.join("./notion_data/.manifests", get_backend(), index_name, name)
+
+
+def checkpoint_path(content_path):
+    """Returns where the progress of the job embedding a contents store is kept, next to its manifest."""
+    return os.path.splitext(manifest_path(content_path))[0] + ".checkpoint.json"
+
 
-    print(row)
+def record_rows(manifest, row_ids, splits, duplicate_of):
+    """Records the rows in the manifest with the ids of all their splits, and the split that each of their splits
+    skipped as a near-duplicate duplicates, from `duplicate_of`. Row ids are content hashes, so they are their own hash."""
+    chunk_ids = {}
+    for split in splits:
+        chunk_ids.setdefault(split.metadata["row_id"], []).append(split.metadata["id"])
+    for row_id in row_ids:
+        ids = chunk_ids.get(row_id, [])
+        manifest.update(row_id, row_id, ids, {id: duplicate_of[id] for id in ids if id in duplicate_of})
 
+
+def removed_rows(content_path, manifest):
+    """Returns the rows of the manifest that are no longer in the contents store, e.g. the previous version of the
+    changed and deleted articles."""
+    current = set(ChunkStore(content_path).table(["id"]).column("id").to_pylist())
+    return [row_id for row_id in manifest.pages if row_id not in current]
+
+
+def delete_removed_rows(content_path, index, manifest, keywords=None):
+    """Deletes the vectors and keyword entries of the rows of the manifest that are no longer in the contents store.
+    Returns how many rows were removed."""
+    removed = removed_rows(content_path, manifest)
+    # pinecone deletes up to 1000 ids per call
+    stale_ids = [id for row_id in removed for id in manifest.chunk_ids(row_id)]
+    with span("delete_stale", chunks=len(stale_ids)):
+        for ids in batched(stale_ids, 1000):
+            index.delete(ids=ids)
+        if keywords is not None:
+            keywords.delete(ids=stale_ids)
+    for row_id in removed:
+        manifest.remove(row_id)
+    return len(removed)
+
+
+def open_index():
+    """Opens the existing index, Pinecone or local depending on VECTOR_BACKEND."""
+    if get_backend() == "local":
+        return open_local_index(index_name)
+    pinecone = Pinecone(api_key=os.getenv("PINECONE_API_KEY"), environment=os.getenv("PINECONE_ENV"))
+    return pinecone.Index(index_name)
+
+
+def embed_content(content_path, index, embeddings, checkpoint, chunksize=1000, batch_size=100, max_workers=4, keywords=None, dedup=None,
+                  manifest=None, reembed=False):
+    """Embeds the contents store chunk by chunk: every chunk is split in bulk, embedded in batches and upserted,
+    and appended to the journal of the local index and of the `keywords` index if any, then the checkpoint moves
+    past it. The indexes are saved once all the chunks are in.
+    The `dedup` filter, if any, drops the splits that are near-duplicates of a split seen before in this run.
+    With a `manifest`, the rows it has are not embedded again unless `reembed` is set, and the vectors of the rows
+    it has that are no longer in the store are deleted once all the chunks are in. The manifest is saved then,
+    and the checkpoint is cleared. The splits that were skipped as near-duplicates of a split of those rows go
+    through the filter again, and are embedded if they duplicate nothing else."""
     # split the text into chunks of 500 characters with 0 overlap
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=0)
-    all_splits = text_splitter.split_documents(row['content'])
+    removed = removed_rows(content_path, manifest) if manifest is not None else []
+    gone = {id for row_id in removed for id in manifest.chunk_ids(row_id)}
 
-    vectordb = Pinecone.from_documents(all_splits[:1], embeddings, index_name=index_name)
+    def sync(rows, embed=True):
+        """Splits, filters and embeds a chunk of rows, and records them in the manifest. With `embed` False,
+        the rows were embedded by an interrupted run: the same decisions are made, from the same manifest, to record
+        them as it would have. Returns how many rows were already embedded."""
+        with span("split", rows=rows.num_rows):
+            all_splits = split_rows(rows, text_splitter)
+        row_ids = rows.column("id").to_pylist()
+        new_rows = set(row_ids)
+        pending, duplicate_of = all_splits, {}
+        if manifest is not None and not reembed:
+            # the ids are content hashes, a row in the manifest is embedded as it is, but for its splits that
+            # duplicate a split that is gone
+            new_rows = {row_id for row_id in row_ids if manifest.digest(row_id) is None}
+            pending, embedded = [], []
+            for split in all_splits:
+                row_id, id = split.metadata["row_id"], split.metadata["id"]
+                target = manifest.duplicates(row_id).get(id)
+                if row_id in new_rows or target in gone:
+                    pending.append(split)
+                elif target is None:
+                    embedded.append(split)
+                else:
+                    duplicate_of[id] = target
+            if dedup is not None:
+                dedup.remember(embedded)
+        # the rows recorded again: the new ones and the ones with splits to embed
+        updated = new_rows | {split.metadata["row_id"] for split in pending}
+        kept = pending
+        if dedup is not None:
+            start = len(dedup.duplicates)
+            with span("dedup", splits=len(pending)):
+                kept = list(dedup.filter(pending))
+            duplicate_of.update(dedup.duplicate_of(start))
+        if embed:
+            print(f"Rows {rows_done} to {rows_done + rows.num_rows}: {len(kept)} splits")
+            embed_and_upsert(kept, embeddings, index, batch_size=batch_size, max_workers=max_workers)
+            with span("save"):
+                if get_backend() == "local":
+                    # journaled only, the whole index is saved once after the last chunk
+                    index.journal()
+                if keywords is not None:
+                    # journaled only, the postings are built once after the last chunk
+                    keywords.append(kept)
+            count("rows_embedded", len(new_rows))
+        if manifest is not None:
+            record_rows(manifest, [row_id for row_id in row_ids if row_id in updated],
+                        [split for split in all_splits if split.metadata["row_id"] in updated], duplicate_of)
+        return len(row_ids) - len(new_rows)
 
-    for i in tqdm.tqdm(range(1, len(all_splits))):
-        vectordb.add_documents(all_splits[:i])
-    
-    return
+    rows_done = checkpoint.rows_done
+    rows_skipped = 0
+    if rows_done:
+        print(f"Resuming after the {rows_done} rows embedded by the previous run...")
+        if manifest is not None or dedup is not None:
+            replayed = 0
+            for rows in read_content_chunks(content_path, chunksize=chunksize):
+                rows = rows.slice(0, rows_done - replayed)
+                rows_skipped += sync(rows, embed=False)
+                replayed += rows.num_rows
+                if replayed >= rows_done:
+                    break
 
-# Function to upsert the embeddings to Pinecone
-def embed_dataframe(df: pd.DataFrame):
+    for rows in read_content_chunks(content_path, chunksize=chunksize, skip_rows=rows_done):
+        rows_skipped += sync(rows)
+        rows_done += rows.num_rows
+        checkpoint.save(rows_done)
 
-    print(f"Generating Pinecone embeddings for index:{index_name}...")
-    pinecone.init(api_key=pinecone_api_key, environment=pinecone_env)
-    
-    # upsert each row of the dataframe into the pinecone index, add tqdm for progress bar
-    print(f"Upserting Zendesk embeddings to Pinecone index:{index_name}...")
-    for row in tqdm.tqdm(df.iterrows()):
-        upsert_embedding(row, index_name)
-
-    print(f"Upserted {len(df)} Zendesk embeddings to Pinecone index:{index_name}.")
+    if manifest is not None:
+        removed = delete_removed_rows(content_path, index, manifest, keywords)
+    if get_backend() == "local":
+        with span("save"):
+            index.save()
+    if manifest is not None:
+        manifest.save()
+        print(f"{rows_skipped} rows were already embedded, {removed} rows no longer in {content_path} were deleted")
+        count("rows_removed", removed)
+    if keywords is not None:
+        with span("keyword_index", chunks=len(keywords)):
+            keywords.save()
+    # the run is complete, the next one starts from the top and skips what the manifest has
+    checkpoint.clear()
+    return rows_done
 
 
 def main():
-    content_df = load_content_dataframe()
+    parser = ArgumentParser()
+    parser.add_argument("--content", default="./zendesk_data/contents", help="The contents store produced by index_zendesk.py")
+    parser.add_argument("--chunksize", type=int, default=1000, help="How many rows to read, split and embed at a time")
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=100, help="How many splits to embed and upsert per API call")
+    parser.add_argument("--workers", type=int, default=4, help="How many batches can be in flight at the same time")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint of a previous run and embed the whole store again, rows already embedded included")
+    parser.add_argument("--dedup-threshold", dest="dedup_threshold", type=float, default=0.9, help="Skip the splits whose words overlap this much with a split seen before, 0 to embed them all")
+    parser.add_argument("--dedup-report", dest="dedup_report", default="./.cache/near_duplicates/embed_zendesk.jsonl", help="Where to write which splits were skipped as near-duplicates of which")
+    args = parser.parse_args()
+
+    # Get variables from .env file
+    load_dotenv(find_dotenv())
+
+    # a resumed run goes through the rows before the checkpoint again to record them, it has to take the same decisions
+    checkpoint = Checkpoint(checkpoint_path(args.content), args.content, settings=f"dedup={args.dedup_threshold}")
+    if args.restart:
+        checkpoint.clear()
+        checkpoint.rows_done = 0
 
-    embed_dataframe(content_df)
+    # One embeddings client for the whole job, chunks we've already embedded are read from the local cache
+    embeddings = with_cache(OpenAIEmbeddings())
+    index = open_index()
+    keywords = open_keyword_index(index_name)
+    dedup = NearDuplicateFilter(threshold=args.dedup_threshold) if args.dedup_threshold > 0 else None
+
+    print(f"Upserting Zendesk embeddings to index:{index_name}...")
+    # the run is traced to ./.cache/traces.jsonl, its metrics go to ./.cache/metrics/embed_zendesk.prom
+    with trace("embed_zendesk", content=args.content, resumed_at=checkpoint.rows_done):
+        rows = embed_content(args.content, index, embeddings, checkpoint, chunksize=args.chunksize,
+                             batch_size=args.batch_size, max_workers=args.workers, keywords=keywords, dedup=dedup,
+                             manifest=Manifest(manifest_path(args.content)), reembed=args.restart)
+        if dedup is not None:
+            count("near_duplicates", len(dedup.duplicates))
+    bump_index_version(index_name)
+    print(embeddings.cache.report())
+    if dedup is not None:
+        print(dedup.report())
+        dedup.write_report(args.dedup_report)
+    print(f"Upserted the {rows} rows of {args.content} to index:{index_name}.")
 
     print('All done!')
+
+
 # Entry point
 if __name__ == "__main__":
     main()
@@ -0,0 +1,163 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+from tracing import count, span
+
+
+DEFAULT_CACHE_PATH = "./.cache/embeddings.sqlite"
+DEFAULT_CACHE_MAX_MB = 1024
+
+
+def normalize_text(text):
+    """Normalizes a chunk of text so that cosmetic differences (unicode forms, whitespace) hit the same cache entry."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed cache of embeddings stored as float32 blobs in a SQLite file.
+
+    Entries are keyed by (model name, normalized text). When the stored vectors
+    grow past `max_bytes`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT, vector BLOB, size INTEGER, last_used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model, texts):
+        """Returns the cached embedding of each text, None where it is not cached."""
+        keys = [cache_key(model, text) for text in texts]
+        found = {}
+        with self._lock:
+            # sqlite limits the number of variables in a query, so we look the keys up in slices
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self._conn.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return [array("f", found[key]).tolist() if key in found else None for key in keys]
+
+    def put_many(self, model, texts, vectors):
+        rows = []
+        now = time.time()
+        for text, vector in zip(texts, vectors):
+            blob = array("f", vector).tobytes()
+            rows.append((cache_key(model, text), model, blob, len(blob), now))
+        with self._lock:
+            for key, _, _, size, _ in rows:
+                previous = self._conn.execute("SELECT size FROM embeddings WHERE key = ?", (key,)).fetchone()
+                self._size -= previous[0] if previous else 0
+                self._size += size
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Drops the least recently used entries until the cache fits in `max_bytes`."""
+        while self._size > self.max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM embeddings ORDER BY last_used LIMIT 256").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._size <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self._size -= size
+                self.evictions += 1
+
+    @property
+    def size_bytes(self):
+        return self._size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "size_bytes": self._size,
+        }
+
+    def report(self):
+        stats = self.stats()
+        return (f"embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hit_rate']:.0%} hit rate), {stats['evictions']} evictions, "
+                f"{stats['size_bytes'] / 1024 / 1024:.1f}MB on disk")
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embeddings model so that any text that was already embedded is read from the cache instead of the API."""
+
+    def __init__(self, embeddings, cache, model=None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model or getattr(embeddings, "model", None) or type(embeddings).__name__
+
+    def embed_documents(self, texts):
+        vectors = self.cache.get_many(self.model, texts)
+        # only the texts we've never seen are sent to the model, and each of them only once
+        missing = {}
+        for text, vector in zip(texts, vectors):
+            if vector is None:
+                missing.setdefault(normalize_text(text), text)
+        count("embedding_cache_hits", sum(1 for vector in vectors if vector is not None))
+        count("embedding_cache_misses", len(texts) - sum(1 for vector in vectors if vector is not None))
+        if missing:
+            computed = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            self.cache.put_many(self.model, list(missing.values()), list(computed.values()))
+            vectors = [computed[normalize_text(text)] if vector is None else vector
+                       for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed_query(self, text):
+        with span("embed_query") as attributes:
+            vector = self.cache.get_many(self.model, [text])[0]
+            attributes["cached"] = vector is not None
+            count("embedding_cache_hits" if vector is not None else "embedding_cache_misses")
+            if vector is None:
+                vector = self.embeddings.embed_query(text)
+                self.cache.put_many(self.model, [text], [vector])
+        return vector
+
+
+def with_cache(embeddings, path=None, max_mb=None):
+    """Returns the embeddings model backed by the on-disk cache.
+
+    The cache location and size can be set with the EMBEDDING_CACHE_PATH and
+    EMBEDDING_CACHE_MAX_MB environment variables."""
+    path = path or os.getenv("EMBEDDING_CACHE_PATH", DEFAULT_CACHE_PATH)
+    max_mb = max_mb or float(os.getenv("EMBEDDING_CACHE_MAX_MB", DEFAULT_CACHE_MAX_MB))
+    return CachedEmbeddings(embeddings, EmbeddingCache(path, max_bytes=int(max_mb * 1024 * 1024)))
@@ -0,0 +1,100 @@
+"""Offline stand-ins for the OpenAI and Pinecone clients, handy to try the pipelines without spending $."""
+import hashlib
+import re
+import time
+from typing import List
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic, normalized embeddings derived from a hash of the text."""
+
+    def __init__(self, size=1536):
+        self.size = size
+        self.calls = 0
+        self.texts_embedded = 0
+
+    def _embed(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        values = np.random.default_rng(seed).standard_normal(self.size)
+        return (values / (np.linalg.norm(values) or 1.0)).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        self.texts_embedded += len(texts)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class FakeEncoding:
+    """Stand-in for a tiktoken encoding that needs no download: every word and punctuation sign is a token."""
+
+    name = "fake"
+    pattern = re.compile(r"\w+|[^\w\s]")
+
+    def encode_ordinary(self, text):
+        return self.pattern.findall(text)
+
+    def encode_ordinary_batch(self, texts, num_threads=8):
+        return [self.encode_ordinary(text) for text in texts]
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+class InMemoryIndex:
+    """Minimal stand-in for a Pinecone index that keeps the vectors in a dict."""
+
+    def __init__(self):
+        self.vectors = {}
+        self.upserts = 0
+
+    def upsert(self, vectors, namespace=None):
+        self.upserts += 1
+        for id, values, metadata in vectors:
+            self.vectors[id] = (values, metadata)
+        return {"upserted_count": len(vectors)}
+
+    def delete(self, ids=None, delete_all=False, namespace=None):
+        if delete_all:
+            self.vectors.clear()
+        for id in ids or []:
+            self.vectors.pop(id, None)
+
+    def describe_index_stats(self):
+        return {"total_vector_count": len(self.vectors)}
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """Chat model answering with canned responses, in turn, one word at a time.
+
+    Like ChatOpenAI with `streaming=True`, every word goes to the
+    `on_llm_new_token` callbacks before the whole response is returned. The prompts it got are kept in `prompts`."""
+
+    responses: List[str]
+    delay: float = 0.0
+    calls: int = 0
+    prompts: List[str] = []
+
+    @property
+    def _llm_type(self):
+        return "fake-streaming-chat"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        response = self.responses[self.calls % len(self.responses)]
+        self.calls += 1
+        self.prompts.append("\n".join(message.content for message in messages))
+        for token in re.findall(r"\s*\S+", response):
+            if self.delay:
+                time.sleep(self.delay)
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=response))])
@@ -1,61 +1,89 @@
 import os
-import pandas as pd
 import csv
 import html2text
+import re
 import sys
-import requests
-import uuid
-
-from io import StringIO
-from pprint import pprint
-from bs4 import BeautifulSoup
 import argparse
-from transformers import GPT2TokenizerFast
-from typing import Tuple
-import nltk
-from nltk.tokenize import sent_tokenize
-nltk.download('punkt')
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+
+from zendesk_client import CrawlState, ZendeskClient
+from tokens import get_counter
+from ingest import batched
+from manifest import content_hash
+from tracing import trace, span
 
-sys.stdout = open(sys.stdout.fileno(), mode='w', encoding='utf8', buffering=1)
 
+# Define the maximum number of tokens we allow per row
+max_len = 1500
 
-# Create an ArgumentParser object
-parser = argparse.ArgumentParser()
+# The tiktoken encoding used to count tokens, main() sets it from --encoding
+encoding = "cl100k_base"
 
-# Add an argument with a flag and a name
-parser.add_argument("--zendesk", nargs="*", default=["madkudusupport"], help="Specify the Zendesk domains you want to index")
-parser.add_argument("--max_pages", default=1000, help="The maximum amount of Zendesk pages to index")
-parser.add_argument("--out", default="./zendesk_data/contents.csv", help="Specify the filename to save the content")
-parser.add_argument("--min_tokens", default=20, help="Remove content with less than this number of tokens")
-parser.add_argument("--input", default="./input", help="Folder to ingest CSVs from. Rows should be in the format 'heading,answers,answers,...'")
 
-args = parser.parse_args()
-max_pages = int(args.max_pages)
+def token_counter():
+    """Returns the shared token counter, its encoding is only loaded the first time a token is counted."""
+    return get_counter(encoding)
 
-tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+@lru_cache(maxsize=None)
+def sentence_splitter():
+    """Loads the nltk sentence tokenizer, downloading its model the first time it is needed only."""
+    import nltk
+    try:
+        nltk.data.find("tokenizers/punkt")
+    except LookupError:
+        nltk.download("punkt", quiet=True)
+    from nltk.tokenize import sent_tokenize
+    return sent_tokenize
 
 def count_tokens(text: str) -> int:
     """count the number of tokens in a string"""
-    return len(tokenizer.encode(text))
+    return token_counter().count(text)
 
 def reduce_long(
-    long_text: str, long_text_tokens: bool = False, max_len: int = 590
+    long_text: str, max_len: int = 590
 ) -> str:
     """
     Reduce a long text to a maximum of `max_len` tokens by potentially cutting at a sentence end
     """
-    if not long_text_tokens:
-        long_text_tokens = count_tokens(long_text)
-    if long_text_tokens > max_len:
-        sentences = sent_tokenize(long_text.replace("\n", " "))
-        ntokens = 0
-        for i, sentence in enumerate(sentences):
-            ntokens += 1 + count_tokens(sentence)
-            if ntokens > max_len:
-                return ". ".join(sentences[:i][:-1]) + "."
+    sent_tokenize = sentence_splitter()
+    return token_counter().truncate(long_text, max_len, split_sentences=lambda text: sent_tokenize(text.replace("\n", " ")))
+
+
+def content_id(content: str) -> str:
+  """Returns the id of a row: the hash of its content, so the same content always gets the same id."""
+  return content_hash(content)
+
+HEADINGS = ["h1", "h2", "h3", "h4", "h5", "h6"]
+
+# Markers written around each heading in the converted text, they can't appear in the html text itself
+HEADING_START, HEADING_END = "\x02", "\x03"
+SECTIONS_PATTERN = re.compile(r"#* *\x02(.*?)\x03", re.S)
 
-    return long_text
+class SectionTextConverter(html2text.HTML2Text):
+  """html2text converter that marks where every heading starts and ends in its output,
+  so a whole article is parsed and converted in one pass and then cut into sections."""
 
+  def __init__(self):
+    super().__init__(bodywidth=0)
+
+  def handle_tag(self, tag, attrs, start):
+    if tag in HEADINGS and not start:
+      self.o(HEADING_END)
+    super().handle_tag(tag, attrs, start)
+    if tag in HEADINGS and start:
+      self.o(HEADING_START)
+
+def split_html_sections(html: str):
+  """Converts an article to text in a single pass and returns a list of (heading, content) sections.
+
+  A section holds all the text between a heading and the next heading, in
+  document order. Text before the first heading is ignored."""
+  text = SectionTextConverter().handle(html.replace(HEADING_START, "").replace(HEADING_END, ""))
+  parts = SECTIONS_PATTERN.split(text)
+  return [(" ".join(heading.split()), content.strip()) for heading, content in zip(parts[1::2], parts[2::2])]
 
 def extract_html_content(
   title_prefix: str,
@@ -65,38 +93,13 @@ def extract_html_content(
 ):
   nuuids, ncontents, nurls = [], [], []
 
-  soup = BeautifulSoup(html, 'html.parser')
-  headings = soup.find_all(["h1", "h2", "h3", "h4", "h5", "h6"])
-
   prev_heading = []
 
-  # Iterate through all headings and subheadings
-  for h in headings:
-    # Extract the heading text and remove HTML
-    heading = html2text.html2text(str(h)).strip()
-
-    # Initialize the content list
-    content = []
-
-    # Find the next heading or subheading
-    next_h = h.find_next(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
-
-    actual_heading = heading.lstrip('#').lstrip(' ')
-
-    # Iterate through all siblings until the next heading or subheading is reached
-    for sibling in h.next_siblings:
-      if sibling == next_h:
-        break
-
-      # If the sibling is a tag, extract the text and remove HTML
-      if sibling.name:
-        para = html2text.html2text(str(sibling)).strip()
-        if len(para) > 0:
-          content.append(para)
-
-    # If there are content entries, join them all together, clean up for utf-8 and write the row
+  # Iterate through all headings and subheadings, with the text up to the next one
+  for actual_heading, content in split_html_sections(html):
+    # If there is content, clean it up for utf-8 and write the row
     if len(content) > 0:
-      content = "".join(content).replace("\n", "").encode('utf-8').decode('utf-8')
+      content = content.replace("\n", "").encode('utf-8').decode('utf-8')
 
       # If there are headings above this one without content, we concat them here
       if len(prev_heading) > 0:
@@ -106,9 +109,9 @@ def extract_html_content(
 
       title = f"{title_prefix} - {page_title}"
       # Store the extracted title, heading, content
-      row_uuid = str(uuid.uuid4())
-      nuuids.append(row_uuid)
-      ncontents.append(f"{title} - {full_heading} - {content}")
+      row = f"{title} - {full_heading} - {content}"
+      nuuids.append(content_id(row))
+      ncontents.append(row)
       nurls.append(url)
       prev_heading = []
     else:
@@ -123,71 +126,86 @@ def count_content_tokens(
   ncontents: list,
   nurls: list
 ):
-  """This function takes a list of tuples (title, heading, content, tokens) and returns a list of tuples (title, heading, content, tokens)"""
-  # count the tokens of each section
+  """This function takes the lists of ids, contents and urls and returns a list of tuples (id, url, content, tokens)"""
+  # count the tokens of every content and url in one batch
+  content_tokens = token_counter().count_batch(ncontents)
+  url_tokens = token_counter().count_batch(nurls)
   ncontent_ntokens = [
-      count_tokens(c) # Add the tokens from the content
+      c_tk # Add the tokens from the content (which includes the title and the headings)
       + 4
-      + count_tokens(" ".join(id.split(" ")[1:-1])) # Add the tokens from the headings
-      + count_tokens(" ".join(u.split(" ")[1:-1])) # Add the tokens from the url
+      + u_tk # Add the tokens from the url
       - (1 if len(c) == 0 else 0)
-      for id, c, u in zip(nuuids, nurls, ncontents)
+      for c, c_tk, u_tk in zip(ncontents, content_tokens, url_tokens)
   ]
-  # Create a tuple of (title, section_name, content, number of tokens)
+  # Create a tuple of (id, url, content, number of tokens), cutting the contents that are too long
   outputs = []
-  outputs += [(id, u, c, tk) if tk<max_len 
-              else (id, reduce_long(c, max_len), count_tokens(reduce_long(c,max_len))) 
-                  for id, u, c, tk in zip(nuuids, nurls, ncontents, ncontent_ntokens)]
+  for id, u, c, tk in zip(nuuids, nurls, ncontents, ncontent_ntokens):
+    if tk < max_len:
+      outputs.append((id, u, c, tk))
+    else:
+      reduced = reduce_long(c, max_len)
+      outputs.append((id, u, reduced, count_tokens(reduced)))
   return outputs
 
 def extract_zendesk_domain(
   zendesk_domain: str,
-  limit: int = max_pages
+  limit: int = 1000,
+  incremental: bool = False,
+  workers: int = 8,
+  state_dir: str = "./zendesk_data",
+  unchanged: set = None
 ):
-  """This function extracts the content from a Zendesk domain and returns a list of tuples (title, heading, content, tokens)"""
+  """This function extracts the content from a Zendesk domain and returns a list of tuples (title, heading, content, tokens).
+  With `incremental`, only the new and changed articles are extracted, the urls of the others are added to `unchanged`:
+  their rows of the previous run are still current. The deleted articles are in neither."""
   nuuids, ncontents, nurls = [], [], []
+  crawled = set()
 
   total_pages = 0;
   URL = f"https://{zendesk_domain}.zendesk.com/api/v2/help_center/en-us"
+
+  # Remember what we've crawled, to skip the unchanged listings and articles next time
+  state = CrawlState(os.path.join(state_dir, f".crawl_state_{zendesk_domain}.json")) if incremental else None
+  client = ZendeskClient(URL, max_workers=workers, state=state)
   
   print(f"Fetching up to {limit} pages from 'https://{zendesk_domain}.zendesk.com'...")
 
-  # Fetch the Categories from Zendesk
-  cat_response = requests.get(URL + '/categories.json')
-  cat_data = cat_response.json()
-  for category in cat_data['categories']:
+  # Walk the categories, sections and articles, every listing page is fetched concurrently
+  complete = True
+  for category, section, article in client.crawl():
+    if total_pages >= limit:
+      complete = False
+      break
+    crawled.add(str(article['id']))
     category_title = category['name']
-
-    # Fetch the sections within the categories
-    sections_response = requests.get(URL + '/categories/' + str(category['id']) + '/sections.json')
-    sections_data = sections_response.json()
-    for section in sections_data['sections']:
-      page_title = section['name']
-      
-      # Fetch the articles within the section
-      articles_response = requests.get(URL + '/sections/' + str(section['id']) + '/articles.json')
-      articles_data = articles_response.json()
-
-      for article in articles_data["articles"]:
-        page_title += " - " + article['title']
-        page_html = article['body']
-        page_url = article['html_url']
-
-        if (page_html is not None and total_pages < limit ):
-          pageIds, pageContent, pageUrls = extract_html_content(category_title, page_title, page_html, page_url)
-          nuuids += pageIds
-          ncontents += pageContent
-          nurls += pageUrls
-          total_pages += 1
-      
-      if (articles_data['next_page'] is not None):
-        pprint('TODO! But have not seen multiple pages yet at this level (due to using sections...)')
+    page_title = section['name'] + " - " + article['title']
+    page_html = article['body']
+    page_url = article['html_url']
+
+    if page_html is not None:
+      pageIds, pageContent, pageUrls = extract_html_content(category_title, page_title, page_html, page_url)
+      nuuids += pageIds
+      ncontents += pageContent
+      nurls += pageUrls
+      total_pages += 1
+    if state:
+      state.update_article(article)
+
+  print(f"Fetched {total_pages} articles with {client.requests} requests, skipped {client.skipped} unchanged pages and articles")
+  if state:
+    # an article no listing has anymore was deleted, which only a complete crawl can tell
+    deleted = [id for id in state.articles if id not in client.listed] if complete else []
+    for id in deleted:
+      state.remove_article(id)
+    if unchanged is not None:
+      unchanged.update(url for id, url in state.urls.items() if id not in crawled)
+    print(f"{len(deleted)} articles were deleted since the previous run")
+    state.save(pages=complete)
   
   return count_content_tokens(nuuids, ncontents, nurls)
 
-def extract_csvfile(subdir, file):
-    """This function takes our CSV file and returns a list of tuples (title, heading, content, tokens)"""
-    nuuids, ncontents, nurls = [], [], []
+def iter_csvfile(subdir, file):
+    """This function streams our CSV file and yields a tuple (id, content, url) per row"""
     csv_filepath = os.path.join(subdir, file)
     subdir_name = os.path.basename(subdir)
     file_name = os.path.splitext(file)[0]
@@ -200,7 +218,6 @@ def extract_csvfile(subdir, file):
       csv_reader = csv.reader(csv_file)
       for row in csv_reader:
         if row:
-          row_uuid = str(uuid.uuid4())
           content = ""
           if row[0]:
             content += f"{row[0]} -"
@@ -216,38 +233,164 @@ def extract_csvfile(subdir, file):
           else:
             continue
           
-          nuuids.append(row_uuid)
-          ncontents.append(content)
-          nurls.append(file)
-    return count_content_tokens(nuuids, ncontents, nurls)
+          yield content_id(content), content, file
 
+def iter_pdffile(subdir, file):
+    """This function streams the text of our PDF file and yields a tuple (id, content, url) per page"""
+    from pypdf import PdfReader
 
-# Define the maximum number of tokens we allow per row
-max_len = 1500
+    pdf_filepath = os.path.join(subdir, file)
+    subdir_name = os.path.basename(subdir)
+    file_name = os.path.splitext(file)[0]
 
-# For each Space, fetch the content and add to a list(title, heading, content, tokens)
-res = []
+    print(f"Loading data from {pdf_filepath}, subdir: {subdir_name}")
 
-for domain in args.zendesk:
-  print(f"INDEXING CONTENT FROM ZENDESK: {domain}.zendesk.com")
-  res += extract_zendesk_domain(domain)
+    title = f"{subdir_name} - {file_name}"
 
-if os.path.isdir(args.input):
-  for subdir, dirs, files in os.walk(args.input):
-    for file in files:
-      if file.endswith(".csv"):
-        res += extract_csvfile(subdir, file)
-      elif file.endswith(".pdf"):
-        res += index_pdf_content(subdir, file)
+    for number, page in enumerate(PdfReader(pdf_filepath).pages, start=1):
+      text = " ".join((page.extract_text() or "").split())
+      if len(text) > 0:
+        content = f"{title} - page {number} - {text}"
+        yield content_id(content), content, file
 
-  
-# Remove rows with less than 40 tokens
-df = pd.DataFrame(res, columns=["id", "url", "content", "tokens"])
-df = df[df.tokens > args.min_tokens]
-df = df.drop_duplicates(['id'])
-df = df.reset_index().drop('index',axis=1) # reset index
-print(df.head())
-
-# Store the content to a CSV
-df.to_csv(args.out, index=False)
-print(f"Done! File saved to {args.out}")
\ No newline at end of file
+def extract_csvfile(subdir, file):
+    """This function takes our CSV file and returns a list of tuples (id, url, content, tokens)"""
+    rows = list(iter_csvfile(subdir, file))
+    return count_content_tokens(*map(list, zip(*rows))) if rows else []
+
+class ContentWriter:
+  """Writes (id, url, content, tokens) rows to a chunk store as they come, dropping the rows
+  with `min_tokens` tokens or less and the rows whose id was already written.
+  The rows replace the previous content of the store once the writer is closed, `keep_previous`
+  carries rows of the previous content over."""
+
+  def __init__(self, path, min_tokens=20):
+    self.path = path
+    self.min_tokens = min_tokens
+    self.seen = set()
+    self.written = 0
+    self.too_short = 0
+    self.duplicates = 0
+    from chunk_store import ChunkStore
+    self.writer = ChunkStore(path).writer(replace=True)
+
+  def write(self, rows):
+    kept = []
+    for id, url, content, tokens in rows:
+      if tokens <= self.min_tokens:
+        self.too_short += 1
+      elif id in self.seen:
+        self.duplicates += 1
+      else:
+        self.seen.add(id)
+        kept.append({"id": id, "source": url, "url": url, "text": content, "tokens": tokens})
+    self.writer.write(kept)
+    self.written += len(kept)
+
+  def keep_previous(self, urls):
+    """Copies the rows of these urls from the previous content of the store, e.g. the unchanged articles
+    an incremental crawl skipped. Returns how many rows were kept."""
+    from chunk_store import ChunkStore
+    kept = 0
+    for batch in ChunkStore(self.path).read(columns=["id", "url", "text", "tokens"]):
+      rows = [row for row in zip(*(column.to_pylist() for column in batch.columns)) if row[1] in urls and row[0] not in self.seen]
+      self.seen.update(id for id, _, _, _ in rows)
+      self.writer.write({"id": id, "source": url, "url": url, "text": content, "tokens": tokens} for id, url, content, tokens in rows)
+      kept += len(rows)
+    self.written += kept
+    return kept
+
+  def close(self):
+    self.writer.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    # a failed run leaves the previous content in place
+    self.writer.__exit__(*exc)
+
+def index_input_file(path, shard_path, encoding_name="cl100k_base", min_tokens=20, batch_size=1000):
+  """Streams the rows of one CSV or PDF file, in batches, through the token counting and the
+  min tokens filter into a shard chunk store. This runs in a worker process, so it only holds one batch at a time."""
+  global encoding
+  encoding = encoding_name
+  subdir, file = os.path.split(path)
+  rows = iter_pdffile(subdir, file) if file.endswith(".pdf") else iter_csvfile(subdir, file)
+  with ContentWriter(shard_path, min_tokens) as writer:
+    for batch in batched(rows, batch_size):
+      ids, contents, urls = map(list, zip(*batch))
+      writer.write(count_content_tokens(ids, contents, urls))
+  return shard_path, writer.too_short, writer.duplicates
+
+def index_input_folder(input_dir, writer, processes=None, batch_size=1000):
+  """Indexes every CSV and PDF file of the input folder across a process pool and streams the rows into the writer."""
+  from chunk_store import ChunkStore
+  paths = [os.path.join(subdir, file)
+           for subdir, dirs, files in os.walk(input_dir)
+           for file in files if file.endswith((".csv", ".pdf"))]
+  with tempfile.TemporaryDirectory() as shard_dir, ProcessPoolExecutor(max_workers=processes) as executor:
+    futures = [executor.submit(index_input_file, path, os.path.join(shard_dir, str(i)), encoding, writer.min_tokens, batch_size)
+               for i, path in enumerate(paths)]
+    # Merge the shards as the files are done, one memory-mapped batch of rows at a time
+    for future in as_completed(futures):
+      shard_path, too_short, duplicates = future.result()
+      writer.too_short += too_short
+      writer.duplicates += duplicates
+      for batch in ChunkStore(shard_path).read(columns=["id", "url", "text", "tokens"], batch_size=batch_size):
+        writer.write(zip(*(column.to_pylist() for column in batch.columns)))
+      shutil.rmtree(shard_path)
+  return len(paths)
+
+
+def parse_args(argv=None):
+  # Create an ArgumentParser object
+  parser = argparse.ArgumentParser()
+
+  # Add an argument with a flag and a name
+  parser.add_argument("--zendesk", nargs="*", default=["madkudusupport"], help="Specify the Zendesk domains you want to index")
+  parser.add_argument("--max_pages", default=1000, help="The maximum amount of Zendesk pages to index")
+  parser.add_argument("--out", default="./zendesk_data/contents", help="Specify the chunk store directory to save the content to")
+  parser.add_argument("--min_tokens", default=20, help="Remove content with less than this number of tokens")
+  parser.add_argument("--workers", default=8, help="How many Zendesk listings to fetch concurrently")
+  parser.add_argument("--incremental", action="store_true", help="Only extract the Zendesk articles that changed since the previous run")
+  parser.add_argument("--encoding", default="cl100k_base", help="The tiktoken encoding used to count tokens (cl100k_base for the OpenAI chat and embedding models, gpt2 for the GPT-2 tokenizer)")
+  parser.add_argument("--input", default="./input", help="Folder to ingest CSVs and PDFs from. CSV rows should be in the format 'heading,answers,answers,...'")
+  parser.add_argument("--processes", type=int, default=None, help="How many input files to process in parallel (one per CPU by default)")
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  global encoding
+  args = parse_args(argv)
+  encoding = args.encoding
+  sys.stdout = open(sys.stdout.fileno(), mode='w', encoding='utf8', buffering=1)
+
+  # Rows are written to the output as they come, dropping the short ones and the duplicates.
+  # The run is traced to ./.cache/traces.jsonl, its metrics go to ./.cache/metrics/index_zendesk.prom
+  with trace("index_zendesk", out=args.out, incremental=args.incremental) as run:
+    with ContentWriter(args.out, min_tokens=int(args.min_tokens)) as writer:
+      for domain in args.zendesk:
+        print(f"INDEXING CONTENT FROM ZENDESK: {domain}.zendesk.com")
+        with span("zendesk_domain", domain=domain):
+          unchanged = set()
+          writer.write(extract_zendesk_domain(domain, limit=int(args.max_pages), incremental=args.incremental,
+                                              workers=int(args.workers), state_dir=os.path.dirname(args.out), unchanged=unchanged))
+          # the store is rewritten, the rows of the articles an incremental crawl skipped carry over
+          if unchanged:
+            print(f"Kept {writer.keep_previous(unchanged)} rows of {len(unchanged)} unchanged articles")
+
+      if os.path.isdir(args.input):
+        with span("input_folder", path=args.input) as attributes:
+          files = index_input_folder(args.input, writer, processes=args.processes)
+          attributes["files"] = files
+        print(f"Indexed {files} files from {args.input}")
+    run.set(rows=writer.written, too_short=writer.too_short, duplicates=writer.duplicates)
+
+  print(f"Wrote {writer.written} rows, removed {writer.too_short} rows with {writer.min_tokens} tokens or less and {writer.duplicates} duplicates")
+  print(f"Done! Content saved to {args.out}")
+
+
+# Entry point
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,102 @@
+import contextvars
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+import tqdm
+
+from tracing import count, span
+
+
+def batched(iterable, size):
+    """Yields lists of up to `size` items from any iterable, without materializing it."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def doc_id(doc):
+    """Returns the vector id of a document: its `id` metadata if it has one, a random uuid otherwise."""
+    return doc.metadata.get("id") or str(uuid.uuid4())
+
+
+def to_vectors(docs, embeddings, text_key="text"):
+    """Builds the (id, values, metadata) tuples expected by `index.upsert`.
+
+    The chunk text is stored in the metadata under `text_key`, which is where
+    the langchain Pinecone vector store looks for it at query time."""
+    vectors = []
+    for doc, values in zip(docs, embeddings):
+        metadata = dict(doc.metadata)
+        metadata[text_key] = doc.page_content
+        vectors.append((doc_id(doc), values, metadata))
+    return vectors
+
+
+class IngestStats:
+    """Keeps track of what went through the pipeline and how fast."""
+
+    def __init__(self):
+        self.chunks = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def throughput(self):
+        return self.chunks / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self):
+        return (f"embedded and upserted {self.chunks} chunks in {self.batches} batches "
+                f"in {self.elapsed:.1f}s ({self.throughput:.1f} chunks/s)")
+
+
+def embed_and_upsert(docs, embeddings, index, batch_size=100, max_workers=4, namespace=None, text_key="text", progress=True):
+    """Embeds every document exactly once and upserts the vectors into the index.
+
+    `docs` can be any iterable (a list or a generator), it is consumed in batches
+    of `batch_size` documents. Each batch is embedded with a single
+    `embeddings.embed_documents` call and upserted with a single `index.upsert` call.
+    At most `max_workers` batches are in flight at any time, which bounds both
+    the concurrency against the APIs and the memory held by the pipeline.
+
+    `embeddings` is anything with an `embed_documents(texts)` method and `index`
+    anything with an `upsert(vectors=...)` method, e.g. a Pinecone index.
+    """
+    stats = IngestStats()
+    total = len(docs) if hasattr(docs, "__len__") else None
+    progress_bar = tqdm.tqdm(total=total, unit="chunk", disable=not progress)
+    upsert_kwargs = {"namespace": namespace} if namespace else {}
+
+    def process(batch):
+        with span("embed_batch", chunks=len(batch)):
+            values = embeddings.embed_documents([doc.page_content for doc in batch])
+        with span("upsert_batch", chunks=len(batch)):
+            index.upsert(vectors=to_vectors(batch, values, text_key), **upsert_kwargs)
+        count("chunks_embedded", len(batch))
+        return len(batch)
+
+    def collect(done):
+        for future in done:
+            count = future.result()
+            stats.chunks += count
+            stats.batches += 1
+            progress_bar.update(count)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for batch in batched(docs, batch_size):
+            if len(pending) >= max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            # the batch runs in the trace of the caller, if any
+            pending.add(executor.submit(contextvars.copy_context().run, process, batch))
+        collect(wait(pending).done)
+
+    progress_bar.close()
+    print(stats.report())
+    return stats
@@ -0,0 +1,247 @@
+import json
+import math
+import os
+import re
+from array import array
+from collections import Counter
+from typing import Any, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from atomic_files import replacing
+from tracing import span
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[._\-@:/][a-z0-9]+)*")
+PART_PATTERN = re.compile(r"[a-z0-9]+")
+# the chunks appended since the last save, as JSON lines
+JOURNAL = "journal.jsonl"
+
+
+def tokenize(text):
+    """Lowercases and splits a text into words. Compound words like error codes, field names, emails or urls
+    are kept whole, next to their parts, so both `ERR_TIMEOUT` and `timeout` match them."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        if not token.isalnum():
+            tokens += PART_PATTERN.findall(token)
+    return tokens
+
+
+class KeywordIndex:
+    """BM25 keyword index over the same chunks as the vector index.
+
+    The postings are stored as flat numpy arrays: the documents and term
+    frequencies of every term, one after the other, and the offset of each term
+    in them. `save` writes them as .npy files and `load` memory-maps them, so a
+    query only reads the postings of its own terms. Chunk ids, texts and
+    metadata live in a side table. Changes are applied to the side table and
+    the postings are rebuilt on the next search or save. `append` checkpoints
+    new chunks to a journal without rebuilding anything, it is replayed on load.
+    """
+
+    def __init__(self, path=None, k1=1.5, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.ids = []
+        self.texts = []
+        self.metadata = []
+        self._positions = {}
+        self._stale = True
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Opens a saved index, memory-mapping its postings unless `mmap` is False."""
+        index = cls(path)
+        with open(os.path.join(path, "docs.json"), "r", encoding="utf-8") as f:
+            side_table = json.load(f)
+        with open(os.path.join(path, "terms.json"), "r", encoding="utf-8") as f:
+            terms = json.load(f)
+        index.ids = side_table["ids"]
+        index.texts = side_table["texts"]
+        index.metadata = side_table["metadata"]
+        index._positions = {id: position for position, id in enumerate(index.ids)}
+        index._terms = {term: position for position, term in enumerate(terms)}
+        mmap_mode = "r" if mmap else None
+        for name in ("offsets", "doc_ids", "term_freqs", "doc_lengths"):
+            setattr(index, "_" + name, np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode))
+        index._avg_length = float(index._doc_lengths.mean()) if len(index.ids) else 0.0
+        index._stale = False
+        index._replay_journal()
+        return index
+
+    @classmethod
+    def open(cls, path):
+        """Loads the index saved at `path`, or returns an empty one that will be saved there."""
+        if os.path.exists(os.path.join(path, "docs.json")):
+            return cls.load(path)
+        index = cls(path)
+        index._replay_journal()
+        return index
+
+    def _replay_journal(self):
+        journal_path = os.path.join(self.path, JOURNAL)
+        if not os.path.exists(journal_path):
+            return
+        with open(journal_path, "r", encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f if line.endswith("\n")]
+        self.add_documents(Document(page_content=entry["text"], metadata=entry["metadata"]) for entry in entries)
+
+    def _build(self):
+        vocabulary = {}
+        doc_ids, term_ids, term_freqs = array("i"), array("i"), array("i")
+        doc_lengths = np.zeros(len(self.ids), dtype=np.int32)
+        for position, text in enumerate(self.texts):
+            tokens = tokenize(text)
+            doc_lengths[position] = len(tokens)
+            counts = Counter(tokens)
+            doc_ids.extend([position] * len(counts))
+            term_ids.extend(vocabulary.setdefault(term, len(vocabulary)) for term in counts)
+            term_freqs.extend(counts.values())
+        # number the terms in alphabetical order and group the postings by term, documents in order
+        terms = sorted(vocabulary)
+        renumber = np.empty(len(terms), dtype=np.int32)
+        renumber[[vocabulary[term] for term in terms]] = np.arange(len(terms), dtype=np.int32)
+        term_ids = renumber[np.frombuffer(term_ids, dtype=np.int32)]
+        order = np.argsort(term_ids, kind="stable")
+        self._terms = {term: position for position, term in enumerate(terms)}
+        self._offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        self._offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(terms)))
+        self._doc_ids = np.frombuffer(doc_ids, dtype=np.int32)[order]
+        self._term_freqs = np.minimum(np.frombuffer(term_freqs, dtype=np.int32)[order], np.iinfo(np.uint16).max).astype(np.uint16)
+        self._doc_lengths = doc_lengths
+        self._avg_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        self._stale = False
+
+    def save(self, path=None):
+        self.path = path or self.path
+        if self._stale:
+            self._build()
+        arrays = {name + ".npy": np.asarray(getattr(self, "_" + name)) for name in ("offsets", "doc_ids", "term_freqs", "doc_lengths")}
+        documents = {"terms.json": sorted(self._terms, key=self._terms.get),
+                     "docs.json": {"ids": self.ids, "texts": self.texts, "metadata": self.metadata}}
+        with replacing(*(os.path.join(self.path, name) for name in [*arrays, *documents])) as paths:
+            for values, file_path in zip(arrays.values(), paths):
+                with open(file_path, "wb") as f:
+                    np.save(f, values)
+            for content, file_path in zip(documents.values(), paths[len(arrays):]):
+                with open(file_path, "w", encoding="utf-8") as f:
+                    json.dump(content, f)
+        # the journal is in the saved index now
+        if os.path.exists(os.path.join(self.path, JOURNAL)):
+            os.remove(os.path.join(self.path, JOURNAL))
+
+    def append(self, docs):
+        """Adds chunks to the index and appends them to its journal, which costs the size of the chunks only.
+        The journal is replayed when the index is loaded, until the next `save` rebuilds the postings."""
+        docs = list(docs)
+        self.add_documents(docs)
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, JOURNAL), "a", encoding="utf-8") as f:
+            for doc in docs:
+                f.write(json.dumps({"text": doc.page_content, "metadata": doc.metadata}) + "\n")
+
+    def add_documents(self, docs):
+        """Adds chunks to the index, replacing the ones with the same `id` metadata."""
+        for doc in docs:
+            id = doc.metadata["id"]
+            position = self._positions.get(id)
+            if position is None:
+                self._positions[id] = len(self.ids)
+                self.ids.append(id)
+                self.texts.append(doc.page_content)
+                self.metadata.append(dict(doc.metadata))
+            else:
+                self.texts[position] = doc.page_content
+                self.metadata[position] = dict(doc.metadata)
+        self._stale = True
+
+    def delete(self, ids=None, delete_all=False):
+        if delete_all:
+            removed = set(self.ids)
+        else:
+            removed = {id for id in ids or [] if id in self._positions}
+        if not removed:
+            return
+        keep = [position for position, id in enumerate(self.ids) if id not in removed]
+        self.ids = [self.ids[position] for position in keep]
+        self.texts = [self.texts[position] for position in keep]
+        self.metadata = [self.metadata[position] for position in keep]
+        self._positions = {id: position for position, id in enumerate(self.ids)}
+        self._stale = True
+
+    def search(self, query, k=10):
+        """Returns the (document, BM25 score) of the `k` best matching chunks, best first."""
+        if self._stale:
+            self._build()
+        n = len(self.ids)
+        scores = np.zeros(n, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self._terms.get(term)
+            if term_id is None:
+                continue
+            start, end = self._offsets[term_id], self._offsets[term_id + 1]
+            docs = self._doc_ids[start:end]
+            freqs = self._term_freqs[start:end].astype(np.float32)
+            idf = math.log(1 + (n - (end - start) + 0.5) / ((end - start) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[docs] / self._avg_length)
+            scores[docs] += idf * freqs * (self.k1 + 1) / (freqs + norm)
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits])]
+        return [(Document(page_content=self.texts[i], metadata=dict(self.metadata[i])), float(scores[i])) for i in hits]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def document_key(doc):
+    """Tells documents apart by their `id` metadata, or their text."""
+    return doc.metadata.get("id") or doc.page_content
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Merges several rankings of documents into one: each document scores the sum of 1 / (k + rank) over the
+    rankings it appears in. Documents are told apart by their `document_key`."""
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = document_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            docs.setdefault(key, doc)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+class HybridRetriever(BaseRetriever):
+    """Retrieves the `fetch_k` best chunks from both the vector store and the keyword index, and returns the
+    `k` best of their reciprocal rank fusion. Exact error messages, field names and ids are found by the
+    keywords, paraphrased questions by the vectors. The keyword hits have their rank in the `keyword_rank`
+    metadata, so a reranker can fuse it with its own ranking."""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vector_retriever: BaseRetriever
+    keyword_index: Any
+    k: int = 3
+    fetch_k: int = 10
+    rrf_k: int = 60
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        with span("vector_search") as attributes:
+            vector_docs = self.vector_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+            attributes["chunks"] = len(vector_docs)
+        with span("keyword_search") as attributes:
+            keyword_docs = [doc for doc, _ in self.keyword_index.search(query, k=self.fetch_k)]
+            attributes["chunks"] = len(keyword_docs)
+        keyword_ranks = {document_key(doc): rank for rank, doc in enumerate(keyword_docs)}
+        fused = reciprocal_rank_fusion([vector_docs, keyword_docs], k=self.rrf_k)[:self.k]
+        for doc in fused:
+            if document_key(doc) in keyword_ranks:
+                doc.metadata["keyword_rank"] = keyword_ranks[document_key(doc)]
+        return fused
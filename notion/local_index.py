@@ -0,0 +1,240 @@
+import base64
+import json
+import os
+import uuid
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from atomic_files import replacing
+
+# the vectors upserted since the last save, as JSON lines
+JOURNAL = "journal.jsonl"
+
+class LocalIndex:
+    """In-process vector index, a drop-in for the calls we make on a Pinecone index.
+
+    Vectors are normalized and kept as rows of a float32 matrix, so the
+    dot-product top-k matches the `metric='dotproduct'` of our Pinecone index.
+    Ids and metadata live in a side table. `save` writes the matrix as a .npy
+    file and `load` memory-maps it, so opening even a large index is instant and
+    the pages are only read when queried. `journal` checkpoints the vectors
+    upserted since the last save without rewriting the index, it is replayed on load.
+    """
+
+    def __init__(self, path=None, dimension=None):
+        self.path = path
+        self.dimension = dimension
+        self.ids = []
+        self.metadata = []
+        self._positions = {}
+        self._vectors = np.zeros((0, dimension or 0), dtype=np.float32)
+        self._size = 0
+        # the ids upserted since the last save or journal, and whether anything was deleted since the last save
+        self._unsaved = {}
+        self._deleted = False
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Opens a saved index, memory-mapping its vectors unless `mmap` is False."""
+        index = cls(path)
+        with open(os.path.join(path, "metadata.json"), "r", encoding="utf-8") as f:
+            side_table = json.load(f)
+        index.ids = side_table["ids"]
+        index.metadata = side_table["metadata"]
+        index._positions = {id: position for position, id in enumerate(index.ids)}
+        index._vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r" if mmap else None)
+        index._size = len(index.ids)
+        index.dimension = index._vectors.shape[1] if index._size else None
+        index._replay_journal()
+        return index
+
+    @classmethod
+    def open(cls, path):
+        """Loads the index saved at `path`, or returns an empty one that will be saved there."""
+        if os.path.exists(os.path.join(path, "metadata.json")):
+            return cls.load(path)
+        index = cls(path)
+        index._replay_journal()
+        return index
+
+    def _replay_journal(self):
+        journal_path = os.path.join(self.path, JOURNAL)
+        if not os.path.exists(journal_path):
+            return
+        with open(journal_path, "r", encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f if line.endswith("\n")]
+        self.upsert([(entry["id"], np.frombuffer(base64.b64decode(entry["values"]), dtype=np.float32), entry["metadata"])
+                     for entry in entries])
+        self._unsaved = {}
+
+    def save(self, path=None):
+        self.path = path or self.path
+        with replacing(os.path.join(self.path, "vectors.npy"), os.path.join(self.path, "metadata.json")) as (vectors_path, metadata_path):
+            with open(vectors_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(self._vectors[:self._size]))
+            with open(metadata_path, "w", encoding="utf-8") as f:
+                json.dump({"ids": self.ids, "metadata": self.metadata}, f)
+        # the journal is in the saved index now
+        if os.path.exists(os.path.join(self.path, JOURNAL)):
+            os.remove(os.path.join(self.path, JOURNAL))
+        self._unsaved = {}
+        self._deleted = False
+
+    def journal(self):
+        """Appends the vectors upserted since the last save or journal to the journal of the index, which costs their
+        size only. The journal is replayed when the index is loaded, until the next `save` rewrites the index.
+        A delete can't be journaled: after one, the index is saved instead."""
+        if self._deleted:
+            return self.save()
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, JOURNAL), "a", encoding="utf-8") as f:
+            for id in self._unsaved:
+                position = self._positions[id]
+                values = base64.b64encode(np.ascontiguousarray(self._vectors[position]).tobytes()).decode("ascii")
+                f.write(json.dumps({"id": id, "values": values, "metadata": self.metadata[position]}) + "\n")
+        self._unsaved = {}
+
+    def _writable(self, extra_rows=0):
+        """Makes sure the matrix is in memory (not a read-only memory map) and has room for `extra_rows` more rows."""
+        needed = self._size + extra_rows
+        capacity = self._vectors.shape[0]
+        if capacity < needed:
+            capacity = max(needed, 2 * capacity, 1024)
+        elif not isinstance(self._vectors, np.memmap):
+            return
+        vectors = np.zeros((capacity, self.dimension), dtype=np.float32)
+        if self._size:
+            vectors[:self._size] = self._vectors[:self._size]
+        self._vectors = vectors
+
+    @staticmethod
+    def _normalize(values):
+        vectors = np.asarray(values, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def upsert(self, vectors, namespace=None):
+        """Takes (id, values, metadata) tuples, like a Pinecone index."""
+        if not vectors:
+            return {"upserted_count": 0}
+        ids, values, metadata = zip(*vectors)
+        values = self._normalize(values)
+        if self.dimension is None:
+            self.dimension = values.shape[1]
+        if values.shape[1] != self.dimension:
+            raise ValueError(f"Vector dimension {values.shape[1]} does not match the index dimension {self.dimension}")
+        self._writable(len(ids))
+        for id, row, meta in zip(ids, values, metadata):
+            position = self._positions.get(id)
+            if position is None:
+                position = self._size
+                self._positions[id] = position
+                self.ids.append(id)
+                self.metadata.append(meta)
+                self._size += 1
+            else:
+                self.metadata[position] = meta
+            self._vectors[position] = row
+            self._unsaved[id] = None
+        return {"upserted_count": len(ids)}
+
+    def delete(self, ids=None, delete_all=False, namespace=None):
+        if delete_all:
+            self.__init__(self.path, self.dimension)
+            self._deleted = True
+            return
+        ids = [id for id in ids or [] if id in self._positions]
+        if not ids:
+            return
+        self._writable()
+        self._deleted = True
+        for id in ids:
+            # move the last row into the hole so the matrix stays dense
+            position = self._positions.pop(id)
+            last = self._size - 1
+            if position != last:
+                self._vectors[position] = self._vectors[last]
+                self.ids[position] = self.ids[last]
+                self.metadata[position] = self.metadata[last]
+                self._positions[self.ids[position]] = position
+            self.ids.pop()
+            self.metadata.pop()
+            self._size -= 1
+
+    def query(self, vector, top_k=10, include_metadata=True, namespace=None):
+        """Returns the `top_k` closest vectors by dot product, in the same shape as a Pinecone query response."""
+        if self._size == 0:
+            return {"matches": []}
+        scores = self._vectors[:self._size] @ self._normalize(vector)
+        top_k = min(top_k, self._size)
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return {"matches": [
+            {"id": self.ids[i], "score": float(scores[i]),
+             "metadata": self.metadata[i] if include_metadata else None}
+            for i in best
+        ]}
+
+    def fetch(self, ids, namespace=None):
+        """Returns the vectors of these ids, the ones in the index, in the same shape as a Pinecone fetch response."""
+        return {"vectors": {id: {"id": id, "values": self._vectors[self._positions[id]]}
+                            for id in ids if id in self._positions}}
+
+    def describe_index_stats(self):
+        return {"dimension": self.dimension, "total_vector_count": self._size}
+
+    def __len__(self):
+        return self._size
+
+
+class LocalVectorStore(VectorStore):
+    """Langchain vector store on top of a LocalIndex, so the retriever and the chains work with it as they do with Pinecone."""
+
+    def __init__(self, embedding, index, text_key="text"):
+        self._embedding = embedding
+        self.index = index
+        self.text_key = text_key
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        values = self._embedding.embed_documents(texts)
+        self.index.upsert(vectors=[
+            (id, vector, {**metadata, self.text_key: text})
+            for id, vector, metadata, text in zip(ids, values, metadatas, texts)
+        ])
+        return ids
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4):
+        results = []
+        for match in self.index.query(embedding, top_k=k)["matches"]:
+            metadata = dict(match["metadata"])
+            text = metadata.pop(self.text_key, "")
+            results.append((Document(page_content=text, metadata=metadata), match["score"]))
+        return results
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k=k)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k=k)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+    def _select_relevance_score_fn(self):
+        # vectors are normalized, so the dot product is the cosine similarity
+        return lambda score: (score + 1.0) / 2.0
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, path=None, **kwargs):
+        store = cls(embedding, LocalIndex(path))
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+
+from atomic_files import atomic_open
+
+
+def content_hash(text):
+    """Returns a stable hash of a page content."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class Manifest:
+    """Remembers, for every page that was embedded, the hash of its content and the ids of its chunks.
+
+    The manifest is a plain JSON file: {"pages": {path: {"hash": ..., "chunk_ids": [...]}}}.
+    Comparing it with the current export tells us which pages are new or changed
+    (and need to be embedded) and which pages were removed (and need their vectors deleted).
+    The chunks skipped as near-duplicates of another chunk are listed in the "duplicates"
+    of their page, with the id of that chunk: they have to be embedded when it goes away.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.pages = json.load(f).get("pages", {})
+
+    def diff(self, hashes):
+        """Takes a dict of page path -> content hash and returns (changed, removed) lists of page paths."""
+        changed = [path for path, digest in hashes.items()
+                   if self.pages.get(path, {}).get("hash") != digest]
+        removed = [path for path in self.pages if path not in hashes]
+        return changed, removed
+
+    def digest(self, path):
+        """Returns the content hash the page had when it was last embedded, None if it never was."""
+        return self.pages.get(path, {}).get("hash")
+
+    def chunk_ids(self, path):
+        return self.pages.get(path, {}).get("chunk_ids", [])
+
+    def duplicates(self, path):
+        """Returns the chunks of the page that weren't embedded as the near-duplicates of another chunk, as a dict of
+        chunk id -> id of the chunk it duplicates."""
+        return self.pages.get(path, {}).get("duplicates", {})
+
+    def update(self, path, digest, chunk_ids, duplicates=None):
+        self.pages[path] = {"hash": digest, "chunk_ids": list(chunk_ids)}
+        if duplicates:
+            self.pages[path]["duplicates"] = dict(duplicates)
+
+    def remove(self, path):
+        self.pages.pop(path, None)
+
+    def clear(self):
+        self.pages = {}
+
+    def save(self):
+        with atomic_open(self.path) as f:
+            json.dump({"pages": self.pages}, f, indent=1)
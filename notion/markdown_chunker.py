@@ -0,0 +1,178 @@
+import re
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from tokens import get_counter
+
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+LIST_ITEM_PATTERN = re.compile(r"^(?:[-*+]|\d+[.)])\s")
+FENCE_PATTERN = re.compile(r"^\s*(```|~~~)")
+SEPARATOR = "\n\n"
+
+
+def parse_sections(text, title=None):
+    """Splits a markdown page into sections, one per heading, and their blocks.
+
+    Returns a list of (breadcrumb, heading, blocks): the titles of the headings
+    the section is nested under (starting with the page `title` when it isn't
+    the first heading), the heading line, and the paragraphs, list items, tables
+    and code blocks of the section. Nested list items stay with their parent and
+    nothing inside a code block is taken for a heading."""
+    sections = []
+    stack = [(0, title)] if title else []
+    heading = None
+    blocks, block = [], []
+    in_fence = False
+
+    def end_block():
+        if block:
+            blocks.append("\n".join(block))
+            block.clear()
+
+    def end_section():
+        end_block()
+        if blocks or heading:
+            sections.append(([title for _, title in stack], heading, list(blocks)))
+        blocks.clear()
+
+    for line in text.splitlines():
+        if FENCE_PATTERN.match(line):
+            if not in_fence:
+                end_block()
+            in_fence = not in_fence
+            block.append(line)
+            if not in_fence:
+                end_block()
+            continue
+        if in_fence:
+            block.append(line)
+            continue
+        match = HEADING_PATTERN.match(line)
+        if match:
+            end_section()
+            level = len(match.group(1))
+            # the first heading of an export is the page title itself
+            if stack and stack[-1][0] == 0 and stack[-1][1] == match.group(2) and len(stack) == 1:
+                stack.pop()
+            while stack and stack[-1][0] >= level:
+                stack.pop()
+            stack.append((level, match.group(2)))
+            heading = line.strip()
+        elif not line.strip():
+            end_block()
+        elif LIST_ITEM_PATTERN.match(line):
+            end_block()
+            block.append(line)
+        else:
+            block.append(line)
+    end_section()
+    return sections
+
+
+def common_prefix(breadcrumbs):
+    prefix = breadcrumbs[0]
+    for breadcrumb in breadcrumbs[1:]:
+        size = 0
+        while size < min(len(prefix), len(breadcrumb)) and prefix[size] == breadcrumb[size]:
+            size += 1
+        prefix = prefix[:size]
+    return prefix
+
+
+class MarkdownChunker:
+    """Chunks markdown pages along their structure rather than every n characters.
+
+    Pages are cut into sections at their headings and sections into blocks
+    (paragraphs, list items, tables, code blocks). Consecutive blocks, and
+    consecutive small sections, are packed into chunks of at most `max_tokens`
+    tokens, each section keeping its heading line. When a section doesn't fit in
+    one chunk, the next chunk starts with its heading and the last blocks of the
+    previous one, up to `overlap_tokens` tokens. Only blocks larger than the
+    budget on their own are cut inside, and headings longer than half of it.
+    """
+
+    def __init__(self, max_tokens=400, overlap_tokens=50, encoding="cl100k_base"):
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.counter = get_counter(encoding)
+        # the blank line joining the parts of a chunk
+        self._separator_tokens = self.counter.count(SEPARATOR)
+        self._splitters = {}
+
+    def _size(self, counts):
+        """Returns the size of the chunk joining parts of these sizes."""
+        return sum(counts) + self._separator_tokens * (len(counts) - 1) if counts else 0
+
+    def _splitter(self, chunk_size):
+        if chunk_size not in self._splitters:
+            self._splitters[chunk_size] = RecursiveCharacterTextSplitter(
+                chunk_size=chunk_size, chunk_overlap=0, length_function=self.counter.count
+            )
+        return self._splitters[chunk_size]
+
+    def _fit(self, blocks, counts, budget):
+        """Cuts the blocks larger than `budget` tokens, so every block fits in a chunk after the heading of its section."""
+        fitted = []
+        for block, count in zip(blocks, counts):
+            if count <= budget:
+                fitted.append((block, count))
+            else:
+                parts = self._splitter(budget).split_text(block)
+                fitted += zip(parts, self.counter.count_batch(parts))
+        return fitted
+
+    def split(self, text, title=None):
+        """Returns the (breadcrumb, text) of the chunks of a page, the breadcrumb being the headings common to all their sections."""
+        sections = parse_sections(text, title)
+        texts = [heading or "" for _, heading, _ in sections] + [block for _, _, blocks in sections for block in blocks]
+        counts = dict(zip(texts, self.counter.count_batch(texts)))
+
+        chunks = []
+        # the (text, tokens) parts of the current chunk
+        current, breadcrumbs = [], []
+        has_blocks = False
+
+        def size(parts):
+            return self._size([count for _, count in parts])
+
+        def flush():
+            if has_blocks:
+                chunks.append((common_prefix(breadcrumbs), SEPARATOR.join(part for part, _ in current)))
+
+        for breadcrumb, heading, blocks in sections:
+            if heading and counts[heading] > self.max_tokens // 2:
+                # a heading takes half a chunk at most, so that the blocks of its section still fit after it
+                heading = self.counter.truncate(heading, self.max_tokens // 2)
+                counts[heading] = self.counter.count(heading)
+            head = [(heading, counts[heading])] if heading else []
+            # a block has to fit in a chunk after the heading of its section
+            budget = self.max_tokens - size(head + [("", 0)])
+            blocks = self._fit(blocks, [counts[block] for block in blocks], budget)
+            # a whole section goes into the current chunk if it fits, otherwise it starts a new one
+            # (headings without any content yet stay, they are the context of what comes next)
+            if has_blocks and size(current + head + blocks) > self.max_tokens:
+                flush()
+                current, breadcrumbs, has_blocks = [], [], False
+            breadcrumbs.append(breadcrumb)
+            current += head
+            section_blocks = []
+            for block, count in blocks:
+                if size(current + [(block, count)]) > self.max_tokens:
+                    # (when the headings of previous sections without content leave no room, only this one stays)
+                    flush()
+                    # carry over the heading and the last blocks of the section, as far as the overlap goes
+                    overlap = []
+                    for previous, previous_count in reversed(section_blocks):
+                        if size(overlap) + self._separator_tokens + previous_count > self.overlap_tokens:
+                            break
+                        if size(head + [(previous, previous_count)] + overlap + [(block, count)]) > self.max_tokens:
+                            break
+                        overlap.insert(0, (previous, previous_count))
+                    current = head + overlap
+                    section_blocks = list(overlap)
+                    breadcrumbs = [breadcrumb]
+                current.append((block, count))
+                section_blocks.append((block, count))
+                has_blocks = True
+        flush()
+        return chunks
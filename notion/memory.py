@@ -0,0 +1,96 @@
+from context import split_sentences
+
+SUMMARY_TEMPLATE = """Progressively summarize the conversation between a support agent and an AI assistant, adding onto the previous summary and returning a new summary. Keep the product names, error messages and ids. The new summary must be at most {max_words} words long: shorten what the previous summary says rather than leave out the new lines.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{lines}
+
+New summary:"""
+
+
+def llm_summarizer(llm):
+    """Returns a function folding (question, answer) turns into the running summary of a conversation, of about
+    `max_tokens` tokens, in one LLM call."""
+    def summarize(summary, turns, max_tokens):
+        lines = "\n".join(f"Human: {question}\nAI: {answer}" for question, answer in turns)
+        # a token is about three quarters of an English word
+        message = llm.invoke(SUMMARY_TEMPLATE.format(summary=summary or "(empty)", lines=lines, max_words=max_tokens * 3 // 4))
+        return getattr(message, "content", message).strip()
+    return summarize
+
+
+class TokenBudgetMemory:
+    """Conversation memory holding at most `max_tokens` tokens, counted with the model's tokenizer.
+
+    The `window` most recent turns are kept as they are. Older turns are folded
+    into a running summary of at most a quarter of the budget by
+    `summarize(summary, turns, max_tokens)`, or simply dropped when
+    there is no summarizer, so the history sent with every question stays the same
+    size however long the conversation goes on.
+
+    Adding a turn never calls the summarizer: the evicted turns wait in `pending`
+    until `fold_pending` is called, off the path of the answer, e.g. once it's displayed.
+    """
+
+    def __init__(self, token_counter, max_tokens=1000, window=4, summarize=None):
+        self.token_counter = token_counter
+        self.max_tokens = max_tokens
+        self.window = window
+        self.summarize = summarize
+        self.summary = ""
+        self.turns = []
+        self.pending = []
+
+    @property
+    def summary_tokens(self):
+        """The summary can't take more than a quarter of the budget."""
+        return self.max_tokens // 4
+
+    def tokens(self):
+        texts = [self.summary] + [text for turn in self.turns for text in turn]
+        return sum(self.token_counter.count_batch(texts))
+
+    def add(self, question, answer):
+        self.turns.append((question, answer))
+        self._enforce_budget()
+
+    def _evict_oldest(self):
+        turn = self.turns.pop(0)
+        if self.summarize is not None:
+            self.pending.append(turn)
+
+    def fold_pending(self):
+        """Folds the evicted turns into the summary, in a single call of the summarizer. Returns whether it was called."""
+        if not self.pending:
+            return False
+        self.summary = self.summarize(self.summary, self.pending, self.summary_tokens)
+        self.pending = []
+        self._enforce_budget()
+        return True
+
+    def _enforce_budget(self):
+        while len(self.turns) > self.window:
+            self._evict_oldest()
+        while len(self.turns) > 1 and self.tokens() > self.max_tokens:
+            self._evict_oldest()
+        # the summarizer is asked to keep to its budget, should it write more the last sentences that don't fit go
+        self.summary = self.token_counter.truncate(self.summary, self.summary_tokens,
+                                                   split_sentences=lambda text: [sentence.strip() for sentence in split_sentences(text)])
+        if self.turns and self.tokens() > self.max_tokens:
+            # a single turn over the budget: keep the question, cut the answer
+            question, answer = self.turns[-1]
+            remaining = self.max_tokens - self.token_counter.count(self.summary) - self.token_counter.count(question)
+            self.turns[-1] = (question, self.token_counter.truncate(answer, max(remaining, 0)))
+
+    @property
+    def chat_history(self):
+        """Returns the turns of the window as (question, answer) pairs, the `summary` stands for the older ones."""
+        return list(self.turns)
+
+    def clear(self):
+        self.summary = ""
+        self.turns = []
+        self.pending = []
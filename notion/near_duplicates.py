@@ -0,0 +1,143 @@
+import json
+import os
+import re
+import zlib
+from collections import Counter
+
+import numpy as np
+
+WORD_PATTERN = re.compile(r"\w+")
+# an odd 64 bits multiplier to roll the hashes of the words into the hashes of the shingles
+ROLLING_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def lsh_bands(num_perm, threshold):
+    """Returns the (bands, rows) split of the signatures with the highest LSH threshold (1 / bands) ^ (1 / rows)
+    below `threshold`: pairs more similar than that almost always share a band, the candidates get verified anyway."""
+    splits = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    below = [split for split in splits if (1 / split[0]) ** (1 / split[1]) <= threshold]
+    return max(below or splits[:1], key=lambda split: split[1])
+
+
+class MinHasher:
+    """Computes the MinHash signatures of texts, over their shingles of `shingle_size` words."""
+
+    def __init__(self, num_perm=128, shingle_size=5, seed=1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        # the permutations are multiply-shift hashes: the high 32 bits of a * x + b modulo 2^64, with an odd a
+        self._a = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64)[:, None] * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64)[:, None]
+
+    def shingles(self, text):
+        """Returns the 64 bits hashes of the shingles of a text, rolled over the hashes of its words."""
+        words = WORD_PATTERN.findall(text.lower())
+        hashes = np.fromiter((zlib.crc32(word.encode("utf-8")) for word in words), dtype=np.uint64, count=len(words))
+        size = min(self.shingle_size, len(hashes))
+        if size == 0:
+            return np.zeros(1, dtype=np.uint64)
+        count = len(hashes) - size + 1
+        shingles = np.zeros(count, dtype=np.uint64)
+        for offset in range(size):
+            shingles = shingles * np.uint64(ROLLING_MULTIPLIER) + hashes[offset:offset + count]
+        return np.unique(shingles)
+
+    def signature(self, text):
+        shingles = self.shingles(text)[None, :]
+        return ((self._a * shingles + self._b) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+
+class NearDuplicateFilter:
+    """Drops the chunks that are near-duplicates of a chunk seen before, as a streaming stage.
+
+    Each chunk gets a MinHash signature, split in bands. Chunks sharing a band
+    with a previous chunk are candidates, and a candidate is a duplicate when the
+    signatures estimate a Jaccard similarity of their shingles of at least
+    `threshold`. Every chunk is only compared with the few chunks it shares a band
+    with, so the cost stays linear in the number of chunks. The memory held is
+    the signature (4 bytes per permutation) and the band keys of every kept chunk.
+    """
+
+    def __init__(self, threshold=0.9, num_perm=128, shingle_size=5):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm=num_perm, shingle_size=shingle_size)
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+        self._buckets = [{} for _ in range(self.bands)]
+        self._signatures = np.zeros((1024, num_perm), dtype=np.uint32)
+        self._ids = []
+        self._sources = []
+        # how many chunks went through `filter`, and the ones it dropped
+        self.seen = 0
+        self.duplicates = []
+
+    def _band_keys(self, signature):
+        return [hash(signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def _match(self, signature, keys):
+        """Returns the position and estimated similarity of the most similar previous chunk, if similar enough."""
+        candidates = {bucket[key] for bucket, key in zip(self._buckets, keys) if key in bucket}
+        if not candidates:
+            return None, 0.0
+        candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        similarities = (self._signatures[candidates] == signature).mean(axis=1)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None, 0.0
+        return int(candidates[best]), float(similarities[best])
+
+    def _add(self, doc, signature, keys):
+        position = len(self._ids)
+        if position == len(self._signatures):
+            self._signatures = np.concatenate([self._signatures, np.zeros_like(self._signatures)])
+        self._signatures[position] = signature
+        self._ids.append(doc.metadata.get("id"))
+        self._sources.append(doc.metadata.get("source"))
+        for bucket, key in zip(self._buckets, keys):
+            bucket.setdefault(key, position)
+
+    def check(self, doc, record=True):
+        """Returns True when the chunk is new, and remembers it. Otherwise records what it duplicates and returns False."""
+        signature = self.hasher.signature(doc.page_content)
+        keys = self._band_keys(signature)
+        position, similarity = self._match(signature, keys)
+        if position is None:
+            self._add(doc, signature, keys)
+            return True
+        if record:
+            self.duplicates.append({
+                "id": doc.metadata.get("id"), "source": doc.metadata.get("source"),
+                "duplicate_of": self._ids[position], "duplicate_of_source": self._sources[position],
+                "similarity": round(similarity, 3),
+            })
+        return False
+
+    def remember(self, docs):
+        """Registers chunks that are already embedded, so that new chunks duplicating them get dropped."""
+        for doc in docs:
+            self.check(doc, record=False)
+
+    def filter(self, docs):
+        """Yields the chunks that aren't near-duplicates of a previous one, consuming `docs` lazily."""
+        for doc in docs:
+            self.seen += 1
+            if self.check(doc):
+                yield doc
+
+    def duplicate_of(self, start=0):
+        """Returns the chunks dropped since the `start`-th duplicate, as a dict of chunk id -> id of the chunk it duplicates."""
+        return {duplicate["id"]: duplicate["duplicate_of"] for duplicate in self.duplicates[start:] if duplicate["id"]}
+
+    def report(self):
+        top = Counter(duplicate["duplicate_of_source"] for duplicate in self.duplicates).most_common(3)
+        lines = [f"near-duplicates: {len(self.duplicates)} of {self.seen} chunks collapsed "
+                 f"(similarity >= {self.threshold}, {self.bands} bands of {self.rows} rows)"]
+        lines += [f"  {count} copies of chunks from {source}" for source, count in top]
+        return "\n".join(lines)
+
+    def write_report(self, path):
+        """Writes what was collapsed into what as JSON lines."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for duplicate in self.duplicates:
+                f.write(json.dumps(duplicate) + "\n")
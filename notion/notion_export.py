@@ -0,0 +1,122 @@
+import hashlib
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from langchain_core.documents import Document
+
+from ingest import batched
+from manifest import content_hash
+from markdown_chunker import MarkdownChunker
+
+# Notion appends the page id to the exported file names: 'Page title dd2630484a334e159dd9bf07086824ad.md'
+NOTION_ID_PATTERN = re.compile(r"([0-9a-f]{32})$")
+NOTION_URL_PREFIX = 'https://www.notion.so/madkudu/'
+
+
+def notion_page_id(path):
+    """Returns the Notion page id of an exported file, or a hash of its path when its name has none."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    match = NOTION_ID_PATTERN.search(stem)
+    return match.group(1) if match else hashlib.md5(path.encode("utf-8")).hexdigest()
+
+
+def notion_title(path):
+    """Returns the page title of an exported file, its name without the Notion page id."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return NOTION_ID_PATTERN.sub("", stem).strip()
+
+
+def notion_url(path):
+    """Returns the url of the Notion page an exported file comes from, e.g.
+    'Support runbooks/User cannot deploy model from the Studio dd2630484a334e159dd9bf07086824ad.md' ->
+    'https://www.notion.so/madkudu/User-cannot-deploy-model-from-the-Studio-dd2630484a334e159dd9bf07086824ad'."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return NOTION_URL_PREFIX + stem.replace(' ', '-')
+
+
+def iter_markdown_files(notion_dir):
+    """Yields the paths of the markdown pages of an export, always in the same order, without listing it all first."""
+    for root, dirs, files in os.walk(notion_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(".md"):
+                yield os.path.normpath(os.path.join(root, file))
+
+
+@lru_cache(maxsize=None)
+def markdown_chunker(max_tokens, overlap_tokens):
+    return MarkdownChunker(max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+
+
+def split_page(source, text, max_tokens=400, overlap_tokens=50):
+    """Splits a page along its headings and lists into chunks of at most `max_tokens` tokens.
+
+    Each chunk gets a stable id made of the Notion page id and its position in
+    the page, and carries its heading breadcrumb, page id and url. The url is
+    also its `source`, which the LLM quotes back with the answer."""
+    page_id = notion_page_id(source)
+    url = notion_url(source)
+    splits = []
+    for i, (breadcrumb, chunk) in enumerate(markdown_chunker(max_tokens, overlap_tokens).split(text, notion_title(source))):
+        splits.append(Document(page_content=chunk, metadata={
+            "id": f"{page_id}-{i}",
+            "source": url,
+            "url": url,
+            "page_id": page_id,
+            "path": source,
+            "breadcrumb": " > ".join(breadcrumb),
+        }))
+    return splits
+
+
+def load_pages(paths, max_tokens=400, overlap_tokens=50, known=None):
+    """Reads and splits pages, returns the (path, content hash, chunks) of each. This runs in the worker processes.
+    The pages whose hash is the one in `known` (path -> content hash) aren't split, their chunks are None."""
+    pages = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        # the chunking settings are part of the hash, so changing them re-chunks every page
+        digest = content_hash(f"{max_tokens}/{overlap_tokens}\n{text}")
+        if known and known.get(path) == digest:
+            pages.append((path, digest, None))
+        else:
+            pages.append((path, digest, split_page(path, text, max_tokens, overlap_tokens)))
+    return pages
+
+
+def iter_notion_pages(notion_dir, processes=None, max_tokens=400, overlap_tokens=50, files_per_task=16, known=None):
+    """Yields the (path, content hash, chunks) of every page of a Notion export, in file order.
+
+    The files are read and split by a pool of `processes` processes (one per CPU
+    by default, none with 1), `files_per_task` files at a time. At most two tasks
+    per process are in flight, so the memory held doesn't grow with the export.
+    The pages whose content hash is the one in `known` (path -> content hash)
+    aren't split again, they're yielded with None as their chunks.
+    """
+    known = known or {}
+    tasks = ((paths, {path: known[path] for path in paths if path in known})
+             for paths in batched(iter_markdown_files(notion_dir), files_per_task))
+    if processes == 1:
+        for paths, task_known in tasks:
+            yield from load_pages(paths, max_tokens, overlap_tokens, task_known)
+        return
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        max_pending = 2 * (processes or os.cpu_count() or 1)
+        pending = deque()
+        for paths, task_known in tasks:
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+            pending.append(executor.submit(load_pages, paths, max_tokens, overlap_tokens, task_known))
+        while pending:
+            yield from pending.popleft().result()
+
+
+def iter_notion_chunks(notion_dir, **kwargs):
+    """Yields the chunks of every page of a Notion export, see `iter_notion_pages` for the options."""
+    for _, _, chunks in iter_notion_pages(notion_dir, **kwargs):
+        yield from chunks
@@ -0,0 +1,109 @@
+"""Builds the question answering chain, independently of the Streamlit app so it can be reused and shared."""
+import re
+from langchain.chains import RetrievalQAWithSourcesChain
+from langchain.chains.qa_with_sources import stuff_prompt
+from langchain_community.chat_models import ChatOpenAI
+from langchain.prompts import PromptTemplate
+from keyword_index import HybridRetriever
+from context import ContextCompressor
+from backends import index_vectors
+from notion_export import NOTION_URL_PREFIX
+from tokens import counter_for_model
+
+MODEL_NAME = 'gpt-3.5-turbo'
+
+template = """You are a support agent who knows the knowledge base inside-out.
+If you don't know the answer, just say that you don't know, don't try to make up an answer. Tell the user they might need to create a runbook to address this specific question.
+Keep the answer concise.
+Question: {question}
+Helpful Answer:"""
+rag_prompt_custom = PromptTemplate.from_template(template)
+
+# the "stuff" prompt of the chain, with the conversation so far before the question
+combine_prompt = PromptTemplate(
+    template=stuff_prompt.template.replace("QUESTION: {question}\n=========\n{summaries}",
+                                           "{chat_history}QUESTION: {question}\n=========\n{summaries}"),
+    input_variables=["summaries", "question", "chat_history"],
+)
+
+
+def build_llm(openai_api_key, model_name=MODEL_NAME, temperature=0.0, streaming=True):
+    """Returns the chat model answering the questions. With `streaming`, the tokens are sent to the callbacks as they're generated."""
+    return ChatOpenAI(
+        openai_api_key=openai_api_key,
+        model_name=model_name,
+        temperature=temperature,
+        streaming=streaming
+    )
+
+
+def build_retriever(vectordb, k=3, keyword_index=None, fetch_k=10, context_tokens=None, candidates=20, token_counter=None):
+    """Returns the retriever fetching the `k` most similar chunks. With a `keyword_index`, the `fetch_k` best
+    chunks of the vector search and of the keyword search are fused into the `k` returned.
+    With `context_tokens`, `candidates` chunks are fetched instead, reranked and compressed into that many tokens
+    of the `token_counter` (the tokens of the default model by default), see ContextCompressor."""
+    if context_tokens:
+        retriever = build_retriever(vectordb, k=candidates, keyword_index=keyword_index, fetch_k=max(fetch_k, candidates))
+        return ContextCompressor(retriever=retriever, embeddings=vectordb.embeddings, vectors=index_vectors(vectordb),
+                                 max_tokens=context_tokens, token_counter=token_counter or counter_for_model(MODEL_NAME))
+    if keyword_index is None or not len(keyword_index):
+        return vectordb.as_retriever(search_type="similarity", search_kwargs={"k": k})
+    vector_retriever = vectordb.as_retriever(search_type="similarity", search_kwargs={"k": fetch_k})
+    return HybridRetriever(vector_retriever=vector_retriever, keyword_index=keyword_index, k=k, fetch_k=fetch_k)
+
+
+def build_qa_chain(llm, retriever, return_source_documents=False):
+    """Returns the retrieval QA chain. It holds no conversation state, so one chain can serve every session:
+    the history of a conversation is passed along with each question.
+    With `return_source_documents`, the results also hold the chunks retrieved in 'source_documents'."""
+    return RetrievalQAWithSourcesChain.from_chain_type(
+        llm=llm,
+        chain_type="stuff",
+        retriever=retriever,
+        return_source_documents=return_source_documents,
+        chain_type_kwargs={"prompt": combine_prompt}
+    )
+
+
+def format_chat_history(chat_history, summary=""):
+    """Formats the summary and the (question, answer) pairs of a conversation for the prompt, nothing when there are none."""
+    lines = [f"Summary of the earlier conversation: {summary}"] if summary else []
+    lines += [f"Human: {question}\nAI: {answer}" for question, answer in chat_history]
+    return "CONVERSATION SO FAR:\n" + "\n".join(lines) + "\n\n" if lines else ""
+
+
+def ask(qa_chain, query, chat_history=(), summary="", callbacks=None):
+    """Runs a question through the chain and returns its results, with the 'answer' and the 'sources'.
+    The `summary` of the conversation and its `chat_history` (question, answer) pairs go into the prompt before the question.
+    The `callbacks` get the events of this run only, e.g. a StreamHandler to stream the answer."""
+    return qa_chain({'question': query
+                     ,'chat_history': format_chat_history(chat_history, summary)
+                     ,'rag_prompt': rag_prompt_custom
+                     }, callbacks=callbacks)
+
+
+async def aask(qa_chain, query, chat_history=(), summary="", callbacks=None):
+    """Same as `ask`, awaiting the chain so many questions can be answered concurrently."""
+    return await qa_chain.ainvoke({'question': query
+                                   ,'chat_history': format_chat_history(chat_history, summary)
+                                   ,'rag_prompt': rag_prompt_custom
+                                   }, config={'callbacks': callbacks})
+
+
+# create a function to format the sources as a link
+# the Notion chunks carry the url of their page as their source, so they're quoted as is.
+# Chunks embedded before that carry the file path, we get the id from it as described in the example below:
+# if sources = "notion_data/support_runbook/Support runbooks d2a894351f944fc5b4abb9f29f30b4a4/User cannot deploy model from the Studio dd2630484a334e159dd9bf07086824ad.md" then the id is dd2630484a334e159dd9bf07086824ad
+prefix = NOTION_URL_PREFIX
+URL_PATTERN = re.compile(r"https?://[^\s,]+")
+
+def format_sources(sources):
+    formatted_sources = ""
+    if not sources:
+        return formatted_sources
+    urls = URL_PATTERN.findall(sources)
+    if urls:
+        return "\n\n".join(dict.fromkeys(urls))
+    source_id = sources.split('/')[-1].split('.')[0].replace(' ','-')
+    formatted_sources = prefix + source_id
+    return formatted_sources
@@ -0,0 +1,136 @@
+import logging
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+
+class StreamHandler(BaseCallbackHandler):
+    """Hands the answer to `render` as the LLM generates it, token by token.
+
+    The "stuff" QA chain has the LLM write the sources after a "SOURCES:"
+    marker. Everything from the marker on is held back, we format the sources
+    ourselves once the answer is complete. The time to the first token is
+    measured and logged.
+    """
+
+    def __init__(self, render, stop_marker="SOURCES:"):
+        self.render = render
+        self.stop_marker = stop_marker
+        self.text = ""
+        self.tokens = 0
+        self.started = None
+        self.time_to_first_token = None
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        # a retried run starts over
+        self.started = time.perf_counter()
+        self.text = ""
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.on_llm_start(serialized, messages, **kwargs)
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - (self.started or time.perf_counter())
+            logger.info("time to first token: %.0fms", self.time_to_first_token * 1000)
+        self.tokens += 1
+        self.text += token
+        self.render(self.visible_text())
+
+    def visible_text(self):
+        """Returns the text generated so far, without the sources marker nor what follows it."""
+        position = self.text.find(self.stop_marker)
+        if position >= 0:
+            return self.text[:position].rstrip()
+        # the marker may be arriving token by token, don't show its beginning
+        for length in range(len(self.stop_marker) - 1, 0, -1):
+            if self.text.endswith(self.stop_marker[:length]):
+                return self.text[:-length]
+        return self.text
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Times the retrieval, the prompt assembly and the LLM call of a chain run into a trace, and counts the
+    chunks retrieved and the tokens in and out (with `token_counter`, when the LLM doesn't report them)."""
+
+    def __init__(self, trace, token_counter=None):
+        self.trace = trace
+        self.token_counter = token_counter
+        self.tracer = get_tracer()
+        self._starts = {}
+        self._nested = set()
+        self._retrieved = None
+        self._prompt_tokens = {}
+        self._first_token = {}
+
+    def _tokens(self, texts):
+        return sum(self.token_counter.count_batch(texts)) if self.token_counter is not None else None
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        # the retrievers nested in the hybrid one or in the context compressor are timed by their own spans
+        if parent_run_id in self._starts or parent_run_id in self._nested:
+            self._nested.add(run_id)
+        else:
+            self._starts[run_id] = time.perf_counter()
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._nested.discard(run_id)
+        started = self._starts.pop(run_id, None)
+        if started is None:
+            return
+        self._retrieved = time.perf_counter()
+        self.tracer.add_span(self.trace, "retrieve", started, self._retrieved - started, {"chunks": len(documents)})
+        self.tracer.count(self.trace, "chunks_retrieved", len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._nested.discard(run_id)
+        started = self._starts.pop(run_id, None)
+        if started is not None:
+            self.tracer.add_span(self.trace, "retrieve", started, time.perf_counter() - started, {"error": type(error).__name__})
+
+    def _llm_started(self, run_id, texts):
+        now = time.perf_counter()
+        self._starts[run_id] = now
+        if self._retrieved is not None:
+            # between the end of the retrieval and the LLM call, the chain stuffs the chunks in the prompt
+            self.tracer.add_span(self.trace, "prompt", self._retrieved, now - self._retrieved)
+            self._retrieved = None
+        self._prompt_tokens[run_id] = self._tokens(texts)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._llm_started(run_id, prompts)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._llm_started(run_id, [message.content for batch in messages for message in batch])
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        if run_id not in self._first_token:
+            self._first_token[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._starts.pop(run_id, None)
+        if started is None:
+            return
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", self._prompt_tokens.pop(run_id, None))
+        completion_tokens = usage.get("completion_tokens")
+        if completion_tokens is None:
+            completion_tokens = self._tokens([generation.text for generations in response.generations for generation in generations])
+        attributes = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+        first_token = self._first_token.pop(run_id, None)
+        if first_token is not None:
+            attributes["first_token_ms"] = round((first_token - started) * 1000, 3)
+        self.tracer.add_span(self.trace, "llm", started, time.perf_counter() - started, attributes)
+        if prompt_tokens is not None:
+            self.tracer.count(self.trace, "prompt_tokens", prompt_tokens)
+        if completion_tokens is not None:
+            self.tracer.count(self.trace, "completion_tokens", completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        started = self._starts.pop(run_id, None)
+        if started is not None:
+            self.tracer.add_span(self.trace, "llm", started, time.perf_counter() - started, {"error": type(error).__name__})
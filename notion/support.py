@@ -1,73 +1,95 @@
 # Import necessary modules
+import logging
 import streamlit as st
-from langchain.chains import RetrievalQAWithSourcesChain
-from langchain_community.chat_models import ChatOpenAI
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import PromptTemplate
-from utils import init_rag, add_sidebar, format_sources
+from qa import MODEL_NAME, ask
+from streaming import StreamHandler, TracingCallbackHandler
+from tokens import counter_for_model
+from tracing import configure, trace, span, count
+from utils import RECONNECT_ERRORS, get_qa_chain, get_answer_cache, check_health, reset_resources, new_memory, add_sidebar, add_trace_panel, show_trace, show_cache_stats, format_sources
+
+# Log the time to first token of every answer
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+# Every question is traced to ./.cache/traces.jsonl, the metrics go to ./.cache/metrics/support.prom
+configure("support")
 
 # Set up the Streamlit app
 st.set_page_config(page_title="MadKudu: Support Rubook Chat 🧠", page_icon=":robot_face:")
 st.title("🤖 MadKudu: Chat with our Notion Support Runbooks 🧠")
 
-# Set up the sidebar
-add_sidebar(st)
-
-# initialize the variables
+# initialize the variables, the vector store, the LLM and the chain are shared by all the sessions
 with st.spinner("Initializing..."):
         # get the index
         index_name = 'notion-db-chatbot'
-        openai_api_key, vectordb = init_rag(index_name)
+        check_health(index_name)
+        qa_chain = get_qa_chain(index_name)
+        answer_cache = get_answer_cache(index_name)
 st.success("Ready to go! Please write your question in the chat box below", icon="✅")
 
-# initialize the LLM
-llm = ChatOpenAI(
-        openai_api_key=openai_api_key,
-        model_name='gpt-3.5-turbo',
-        temperature=0.0
-    )
-
-template = """You are a support agent who knows the knowledge base inside-out.
-If you don't know the answer, just say that you don't know, don't try to make up an answer. Tell the user they might need to create a runbook to address this specific question.
-Keep the answer concise.
-Question: {question}
-Helpful Answer:"""
-rag_prompt_custom = PromptTemplate.from_template(template)
+# Set up the sidebar
+cache_stats = add_sidebar(st, answer_cache)
+trace_panel = add_trace_panel(st)
 
+# the memory sent with every question is bounded, older turns are summarized
 if "memory" not in st.session_state:
-    st.session_state.memory = ConversationBufferMemory(
-        memory_key="chat_history",input_key='question', output_key='answer', return_messages= True
-    )
+    st.session_state.memory = new_memory(index_name)
 
 # create the function that retrieves source information from the retriever
-def query_llm_with_source(retriever, query):
-    qa_chain = RetrievalQAWithSourcesChain.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        memory=st.session_state.memory,
-        retriever=retriever
-    )
-    results = qa_chain({'question': query
-                        ,'chat_history': st.session_state.messages
-                        ,'rag_prompt': rag_prompt_custom
-                        })
+def query_llm_with_source(qa_chain, query, callbacks=None):
+    with trace("question", index=index_name) as question_trace:
+        callbacks = list(callbacks or []) + [TracingCallbackHandler(question_trace, counter_for_model(MODEL_NAME))]
+        memory = st.session_state.memory
+        # the answer to a follow-up depends on the conversation so far, only the questions that open a
+        # conversation are looked up in and saved to the cache, which is shared by all the agents
+        cacheable = not (memory.turns or memory.summary)
+        # the same (or a very similar) question may have been answered already
+        with span("answer_cache") as attributes:
+            results = answer_cache.get(query) if cacheable else None
+            attributes["hit"] = results["cached"] if results else "miss" if cacheable else "skipped"
+        if cacheable:
+            count("answer_cache_hits" if results else "answer_cache_misses")
+        if results is None:
+            try:
+                results = ask(qa_chain, query, chat_history=memory.chat_history, summary=memory.summary, callbacks=callbacks)
+            except RECONNECT_ERRORS:
+                # the shared connection may have gone stale, reconnect once. Other errors, e.g. rate limits
+                # or a bad request, would fail again: they're raised as they are
+                reset_resources()
+                results = ask(get_qa_chain(index_name), query, chat_history=memory.chat_history, summary=memory.summary,
+                              callbacks=callbacks)
+            if cacheable:
+                answer_cache.put(query, results)
+        with span("memory"):
+            memory.add(query, results['answer'])
+    st.session_state.last_trace = question_trace
     st.session_state.messages.append((query, results['answer'] + "\n\n" + format_sources(results['sources'])))
+    # only the turns still in the memory window are displayed, the summary stands for the rest
+    del st.session_state.messages[:-len(st.session_state.memory.turns)]
     return results
 
-retriever = vectordb.as_retriever(search_type="similarity", search_kwargs={"k": 3})
-# st.session_state.retriever = retriever
-
 if "messages" not in st.session_state:
     st.session_state.messages = []    
 #
+if st.session_state.memory.summary:
+    st.caption("Earlier in this conversation: " + st.session_state.memory.summary)
 for message in st.session_state.messages:
     st.chat_message('human').write(message[0])
     st.chat_message('ai').write(message[1])    
 #
 if query := st.chat_input():
     st.chat_message("human").write(query)
-    results = query_llm_with_source(retriever, query)
-    answer = results['answer']
-    sources = format_sources(results['sources'])
-    st.chat_message("ai").write(answer + "\n\n" + sources)
+    with st.chat_message("ai"):
+        answer_placeholder = st.empty()
+        # stream the answer into the chat bubble as the LLM writes it, the sources come once it's done
+        stream_handler = StreamHandler(lambda text: answer_placeholder.write(text + "▌"))
+        results = query_llm_with_source(qa_chain, query, callbacks=[stream_handler])
+        answer = results['answer']
+        sources = format_sources(results['sources'])
+        answer_placeholder.write(answer + "\n\n" + sources)
+    # the turns evicted from the memory are summarized once the answer is displayed, and never for a cached answer,
+    # they wait for the next answer of the LLM
+    if not results.get('cached'):
+        st.session_state.memory.fold_pending()
+    show_cache_stats(cache_stats, answer_cache)
+if trace_panel is not None and "last_trace" in st.session_state:
+    show_trace(trace_panel, st.session_state.last_trace)
 
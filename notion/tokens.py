@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+
+
+class TokenCounter:
+    """Counts and truncates tokens with a tiktoken encoding.
+
+    Strings are encoded in batches (tiktoken spreads them over threads) and the
+    count of every string is memoized, so counting the same heading, url or
+    content twice is a dictionary lookup. `cl100k_base` is the encoding of the
+    OpenAI chat and embedding models we use, `gpt2` matches the GPT-2 tokenizer.
+    The encoding is only loaded the first time it is needed.
+    """
+
+    def __init__(self, encoding="cl100k_base", cache_size=100_000, num_threads=8):
+        self.encoding_name = encoding
+        self.cache_size = cache_size
+        self.num_threads = num_threads
+        self._encoding = None
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(self.encoding_name)
+        return self._encoding
+
+    def encode_batch(self, texts):
+        return self.encoding.encode_ordinary_batch(list(texts), num_threads=self.num_threads)
+
+    def count_batch(self, texts):
+        """Returns the number of tokens of each text, only encoding the texts it hasn't seen yet."""
+        with self._lock:
+            missing = [text for text in dict.fromkeys(texts) if text not in self._counts]
+        if missing:
+            counts = [len(tokens) for tokens in self.encode_batch(missing)]
+            with self._lock:
+                self._counts.update(zip(missing, counts))
+                while len(self._counts) > self.cache_size:
+                    self._counts.popitem(last=False)
+        with self._lock:
+            result = []
+            for text in texts:
+                count = self._counts.get(text)
+                if count is None:
+                    # evicted by a concurrent batch, rare enough to just encode it again
+                    count = len(self.encoding.encode_ordinary(text))
+                else:
+                    self._counts.move_to_end(text)
+                result.append(count)
+            return result
+
+    def count(self, text):
+        return self.count_batch([text])[0]
+
+    def truncate(self, text, max_tokens, split_sentences=None):
+        """Reduces a text to at most `max_tokens` tokens, with a single encoding pass.
+
+        The text is encoded once and cut after `max_tokens` tokens. When a
+        `split_sentences` function is given, the cut is moved back to the end of
+        the last complete sentence."""
+        tokens = self.encoding.encode_ordinary(text)
+        if len(tokens) <= max_tokens:
+            return text
+        prefix = self.encoding.decode(tokens[:max_tokens])
+        if split_sentences is not None:
+            sentences = split_sentences(prefix)
+            if len(sentences) > 1:
+                return " ".join(sentences[:-1])
+        return prefix
+
+
+_counters = {}
+
+
+def get_counter(encoding="cl100k_base"):
+    """Returns the process-wide counter of an encoding, so all the callers share its memoized counts."""
+    if encoding not in _counters:
+        _counters[encoding] = TokenCounter(encoding)
+    return _counters[encoding]
+
+
+def register_encoding(name, encoding):
+    """Makes the shared counter of `name` use `encoding`, e.g. a FakeEncoding to count tokens offline."""
+    counter = TokenCounter(name)
+    counter._encoding = encoding
+    _counters[name] = counter
+    return counter
+
+
+def counter_for_model(model_name):
+    """Returns the shared counter of the encoding an OpenAI model uses, e.g. cl100k_base for gpt-3.5-turbo."""
+    from tiktoken.model import encoding_name_for_model
+    try:
+        return get_counter(encoding_name_for_model(model_name))
+    except KeyError:
+        return get_counter("cl100k_base")
@@ -0,0 +1,225 @@
+"""Timing spans and counters for the question answering path and the ingestion scripts.
+
+A trace covers one unit of work, e.g. answering a question or an ingestion run.
+The spans and counters recorded while it is open are attached to it, and when it
+ends it is appended to a JSON lines log (TRACE_LOG_PATH, ./.cache/traces.jsonl by
+default). Every span and counter also feeds the cumulative metrics of the
+process, which are written in the Prometheus text format to
+METRICS_DIR/<job>.prom (./.cache/metrics by default), ready for the textfile
+collector of the node exporter.
+"""
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from atomic_files import atomic_open
+
+PREFIX = "notion_qa_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# a trace keeps its first spans only, the summary by span name covers all of them
+MAX_SPANS = 200
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    """The spans, counters and attributes of one unit of work."""
+
+    def __init__(self, name, **attributes):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = dict(attributes)
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.summary = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_span(self, name, started, duration, attributes=None):
+        with self._lock:
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append({"name": name, "start_ms": round((started - self.started) * 1000, 3),
+                                   "duration_ms": round(duration * 1000, 3), **(attributes or {})})
+            summary = self.summary.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            summary["count"] += 1
+            summary["total_ms"] = round(summary["total_ms"] + duration * 1000, 3)
+            summary["max_ms"] = max(summary["max_ms"], round(duration * 1000, 3))
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def to_dict(self):
+        return {
+            "trace_id": self.id, "name": self.name, "started_at": self.started_at,
+            "duration_ms": round((self.duration or 0.0) * 1000, 3), "attributes": self.attributes,
+            "counts": self.counts, "summary": self.summary, "spans": self.spans,
+        }
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """Cumulative counters and latency histograms, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            buckets, total, count = self.histograms.get(key, ([0] * len(BUCKETS), 0.0, 0))
+            buckets = [n + (seconds <= bound) for n, bound in zip(buckets, BUCKETS)]
+            self.histograms[key] = (buckets, total + seconds, count + 1)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name}_total counter")
+                typed.add(name)
+            lines.append(f"{PREFIX}{name}_total{_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name}_seconds histogram")
+                typed.add(name)
+            for bound, n in zip(BUCKETS, buckets):
+                lines.append(f"{PREFIX}{name}_seconds_bucket{_labels(labels + (('le', bound),))} {n}")
+            lines.append(f"{PREFIX}{name}_seconds_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{PREFIX}{name}_seconds_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{PREFIX}{name}_seconds_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class Tracer:
+    """Opens the traces of a process, logs them and keeps the metrics of its `job`."""
+
+    def __init__(self, job, log_path=None, metrics_path=None):
+        self.job = job
+        self.log_path = log_path or os.getenv("TRACE_LOG_PATH", "./.cache/traces.jsonl")
+        self.metrics_path = metrics_path or os.path.join(os.getenv("METRICS_DIR", "./.cache/metrics"), job + ".prom")
+        self.metrics = Metrics()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def trace(self, name, **attributes):
+        """Opens a trace: the spans and counts recorded in the block, and in the threads it starts with
+        `contextvars.copy_context`, are attached to it."""
+        trace = Trace(name, **attributes)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        except Exception as error:
+            trace.set(error=type(error).__name__)
+            self.metrics.inc("errors", trace=name)
+            raise
+        finally:
+            _current_trace.reset(token)
+            trace.finish()
+            self.record(trace)
+
+    def add_span(self, trace, name, started, duration, attributes=None):
+        if trace is not None:
+            trace.add_span(name, started, duration, attributes)
+        self.metrics.observe("span", duration, span=name)
+
+    def count(self, trace, name, value=1):
+        if trace is not None:
+            trace.count(name, value)
+        self.metrics.inc(name, value, trace=trace.name if trace is not None else "none")
+
+    def record(self, trace):
+        self.metrics.observe("trace", trace.duration, trace=trace.name)
+        self.metrics.inc("traces", trace=trace.name)
+        line = json.dumps({"job": self.job, **trace.to_dict()}, default=str)
+        with self._lock:
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.write_metrics()
+
+    def write_metrics(self):
+        # the collector never reads half of it
+        with atomic_open(self.metrics_path) as f:
+            f.write(self.metrics.render())
+
+
+_tracer = None
+
+
+def configure(job=None, log_path=None, metrics_path=None):
+    """Sets up the tracer of the process, named after the script by default. Calling it again keeps the same tracer."""
+    global _tracer
+    job = job or os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0] or "python"
+    if _tracer is None or _tracer.job != job:
+        _tracer = Tracer(job, log_path=log_path, metrics_path=metrics_path)
+    return _tracer
+
+
+def get_tracer():
+    return _tracer or configure()
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def trace(name, **attributes):
+    return get_tracer().trace(name, **attributes)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the block into the current trace. The attributes dict it yields can be completed in the block."""
+    started = time.perf_counter()
+    try:
+        yield attributes
+    except Exception as error:
+        attributes["error"] = type(error).__name__
+        raise
+    finally:
+        get_tracer().add_span(current_trace(), name, started, time.perf_counter() - started, attributes)
+
+
+def count(name, value=1):
+    """Adds `value` to a counter of the current trace and of the process metrics."""
+    get_tracer().count(current_trace(), name, value)
+
+
+def format_trace(trace):
+    """Returns the latency breakdown of a trace as markdown lines, the slowest stages first."""
+    lines = [f"**{trace.name}**: {(trace.duration or 0.0) * 1000:.0f}ms"]
+    for name, summary in sorted(trace.summary.items(), key=lambda item: -item[1]["total_ms"]):
+        times = f" ×{summary['count']}" if summary["count"] > 1 else ""
+        lines.append(f"- {name}{times}: {summary['total_ms']:.0f}ms")
+    if trace.counts:
+        lines.append(", ".join(f"{name.replace('_', ' ')}: {value}" for name, value in trace.counts.items()))
+    return "\n".join(lines)
@@ -1,30 +1,132 @@
 import streamlit as st
 import time
 import os
-from langchain.vectorstores import Pinecone
+import requests
+import urllib3
+from openai import APIConnectionError
 from langchain.embeddings.openai import OpenAIEmbeddings
 from dotenv import find_dotenv, load_dotenv
-import pinecone
+from embedding_cache import with_cache
+from backends import open_vectorstore, open_keyword_index, index_version, answer_cache_path, store_index
+from answer_cache import AnswerCache
+from qa import MODEL_NAME, build_llm, build_retriever, build_qa_chain, format_sources
+from memory import TokenBudgetMemory, llm_summarizer
+from tokens import counter_for_model
+from tracing import format_trace
+
+# How often, in seconds, the shared vector store connection is checked
+HEALTH_CHECK_INTERVAL = 60
+# The errors a new connection can fix, raised when a shared client's connection dropped or went stale
+RECONNECT_ERRORS = (ConnectionError, APIConnectionError, requests.ConnectionError,
+                    urllib3.exceptions.ProtocolError, urllib3.exceptions.MaxRetryError)
+_last_health_check = {}
 
 def init_rag(index_name):
     load_dotenv(find_dotenv())
 
-    # initialize connection to pinecone (get API key at app.pinecone.io)
-    pinecone_api_key = os.getenv("PINECONE_API_KEY")
-    # find your environment next to the api key in pinecone console
-    pinecone_env = os.getenv("PINECONE_ENV")
     # get our OpenAI API key
     openai_api_key = os.getenv("OPENAI_API_KEY")
 
-    # get the vector database
-    pinecone.Pinecone(api_key=pinecone_api_key, environment=pinecone_env)
-    embeddings = OpenAIEmbeddings()
-    vectordb = Pinecone.from_existing_index(index_name=index_name, embedding=embeddings)
+    # get the vector database, Pinecone or the local index depending on VECTOR_BACKEND
+    embeddings = with_cache(OpenAIEmbeddings())
+    vectordb = open_vectorstore(index_name, embeddings)
 
     return openai_api_key, vectordb
 
-def add_sidebar(st):
-    """Adds the sidebar to the streamlit app."""
+# The resources below are created once per process and shared by every session and rerun of the app.
+# The ones reading the index are created again when an ingestion script updates it: the local index and the
+# keyword index are memory-mapped as they were when opened. Only the latest versions are kept.
+
+def get_vectordb(index_name):
+    """Returns the API key and the vector store client of the current version of the index, connecting on first use."""
+    return _get_vectordb(index_name, index_version(index_name))
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _get_vectordb(index_name, version):
+    return init_rag(index_name)
+
+@st.cache_resource(show_spinner=False)
+def get_llm(openai_api_key, model_name=MODEL_NAME, temperature=0.0):
+    return build_llm(openai_api_key, model_name=model_name, temperature=temperature, streaming=True)
+
+def get_qa_chain(index_name, model_name=MODEL_NAME, k=3, context_tokens=None, candidates=None):
+    """Returns the QA chain of a config (index, model, number of chunks retrieved), built once per version of the index and reused.
+    The chunks come from both the vector store and the keyword index, when the ingestion scripts built one.
+    The CONTEXT_CANDIDATES (20 by default) best chunks are compressed into CONTEXT_TOKENS tokens (1500 by default),
+    with CONTEXT_TOKENS=0 the `k` best chunks are sent as they are."""
+    return _get_qa_chain(index_name, index_version(index_name), model_name, k, context_tokens, candidates)
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _get_qa_chain(index_name, version, model_name, k, context_tokens, candidates):
+    openai_api_key, vectordb = _get_vectordb(index_name, version)
+    llm = get_llm(openai_api_key, model_name=model_name)
+    context_tokens = int(os.getenv("CONTEXT_TOKENS", "1500")) if context_tokens is None else context_tokens
+    candidates = int(os.getenv("CONTEXT_CANDIDATES", "20")) if candidates is None else candidates
+    retriever = build_retriever(vectordb, k=k, keyword_index=open_keyword_index(index_name), context_tokens=context_tokens,
+                                candidates=candidates, token_counter=counter_for_model(model_name))
+    return build_qa_chain(llm, retriever)
+
+@st.cache_resource(show_spinner=False)
+def get_answer_cache(index_name, threshold=0.95, ttl=24 * 3600, max_entries=1000):
+    """Returns the answer cache shared by all the sessions, it is invalidated when the index is rebuilt.
+    It starts with the answers saved by `ask_batch.py --warm-cache` on the current version of the index."""
+    _, vectordb = get_vectordb(index_name)
+    answer_cache = AnswerCache(vectordb.embeddings, threshold=threshold, ttl=ttl, max_entries=max_entries,
+                               version=lambda: index_version(index_name))
+    answer_cache.load(answer_cache_path(index_name))
+    return answer_cache
+
+def new_memory(index_name, model_name=MODEL_NAME, max_tokens=1000, window=4):
+    """Returns the conversation memory of a session: the last `window` turns, the older ones summarized,
+    at most `max_tokens` tokens of the model altogether."""
+    openai_api_key, _ = get_vectordb(index_name)
+    summarize = llm_summarizer(get_llm(openai_api_key, model_name=model_name))
+    return TokenBudgetMemory(counter_for_model(model_name), max_tokens=max_tokens, window=window, summarize=summarize)
+
+def reset_resources():
+    """Drops the shared clients and chains, the next call reconnects."""
+    _get_vectordb.clear()
+    _get_qa_chain.clear()
+
+def check_health(index_name):
+    """Checks, at most every HEALTH_CHECK_INTERVAL seconds, that the shared vector store still answers.
+    If it doesn't, the shared resources are dropped so they get reconnected lazily."""
+    now = time.monotonic()
+    if now - _last_health_check.get(index_name, 0) < HEALTH_CHECK_INTERVAL:
+        return True
+    _last_health_check[index_name] = now
+    _, vectordb = get_vectordb(index_name)
+    index = store_index(vectordb)
+    try:
+        if index is not None:
+            index.describe_index_stats()
+        return True
+    except Exception:
+        reset_resources()
+        return False
+
+def show_cache_stats(placeholder, answer_cache):
+    """Writes the hit and miss counters of the answer cache into a sidebar placeholder."""
+    stats = answer_cache.stats()
+    placeholder.caption(
+        f"Answer cache: {stats['exact_hits']} exact hits, {stats['semantic_hits']} similar hits, "
+        f"{stats['misses']} misses ({stats['hit_rate']:.0%} hit rate), {stats['entries']} answers cached"
+    )
+
+def add_trace_panel(st):
+    """Adds a toggle to the sidebar showing how long each stage of the last answer took.
+    Returns the placeholder of the breakdown, None when the toggle is off."""
+    with st.sidebar:
+        if st.toggle("Show the latency breakdown"):
+            return st.empty()
+    return None
+
+def show_trace(placeholder, trace):
+    placeholder.markdown(format_trace(trace))
+
+def add_sidebar(st, answer_cache=None):
+    """Adds the sidebar to the streamlit app. Returns the placeholder of the answer cache counters, if any."""
+    cache_stats = None
     with st.sidebar:
 
         st.markdown("# Hi, I am Nygel 🐈")
@@ -63,6 +165,12 @@ def add_sidebar(st):
         disclaimer = '<p style="font-size: 10px;">This LLM can make mistakes. Consider checking important information.</p>'
         st.markdown(disclaimer, unsafe_allow_html=True)
 
+        if answer_cache is not None:
+            cache_stats = st.empty()
+            show_cache_stats(cache_stats, answer_cache)
+
+    return cache_stats
+
 def get_conversation_string():
     conversation_string = ""
     for i in range(len(st.session_state['responses'])-1):
@@ -71,16 +179,3 @@ def get_conversation_string():
         conversation_string += "Bot: "+ st.session_state['responses'][i+1] + "\n"
     return conversation_string
 
-
-# create a function to format the sources as a link
-# we will get the id from the metadata of the retrieved document as described in the example below:
-# if sources = "notion_data/support_runbook/Support runbooks d2a894351f944fc5b4abb9f29f30b4a4/User cannot deploy model from the Studio dd2630484a334e159dd9bf07086824ad.md" then the id is dd2630484a334e159dd9bf07086824ad
-prefix = 'https://www.notion.so/madkudu/'
-
-def format_sources(sources):
-    formatted_sources = ""
-    if sources is None:
-        return formatted_sources
-    source_id = sources.split('/')[-1].split('.')[0].replace(' ','-')
-    formatted_sources = prefix + source_id
-    return formatted_sources
\ No newline at end of file
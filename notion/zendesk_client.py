@@ -0,0 +1,172 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from atomic_files import atomic_open
+
+
+class CrawlState:
+    """Remembers what we've seen during the previous crawl of a help center.
+
+    For every listing page we keep its ETag (and its next page and the ids it
+    lists, since a `304 Not Modified` response has no body), and for every
+    article its `updated_at` and its url. The next crawl can then skip the pages
+    and the articles that didn't change, and tell which articles were deleted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}
+        self.articles = {}
+        self.urls = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            # the states saved before the urls were kept can't tell what a changed article replaces, start over
+            if "urls" in data:
+                self.pages = data.get("pages", {})
+                self.articles = data.get("articles", {})
+                self.urls = data["urls"]
+
+    def etag(self, url):
+        return self.pages.get(url, {}).get("etag")
+
+    def next_page(self, url):
+        return self.pages.get(url, {}).get("next_page")
+
+    def page_ids(self, url):
+        return self.pages.get(url, {}).get("ids", [])
+
+    def update_page(self, url, etag, next_page, ids=()):
+        with self._lock:
+            self.pages[url] = {"etag": etag, "next_page": next_page, "ids": list(ids)}
+
+    def is_unchanged(self, article):
+        return self.articles.get(str(article["id"])) == article.get("updated_at")
+
+    def url(self, article_id):
+        """Returns the url of an article as of the previous crawl, None if it wasn't crawled."""
+        return self.urls.get(str(article_id))
+
+    def update_article(self, article):
+        with self._lock:
+            self.articles[str(article["id"])] = article.get("updated_at")
+            self.urls[str(article["id"])] = article.get("html_url")
+
+    def remove_article(self, article_id):
+        with self._lock:
+            self.articles.pop(str(article_id), None)
+            self.urls.pop(str(article_id), None)
+
+    def save(self, pages=True):
+        """Saves the state. Pass `pages=False` when the crawl stopped early: the listing pages
+        we've seen may hold articles we didn't process, so they must be fetched again next time."""
+        if not pages:
+            with self._lock:
+                self.pages = {}
+        with atomic_open(self.path) as f:
+            json.dump({"pages": self.pages, "articles": self.articles, "urls": self.urls}, f)
+
+
+class ZendeskClient:
+    """Crawls a Zendesk help center: categories -> sections -> articles.
+
+    All the requests go through one pooled `requests.Session`, listings are
+    fetched concurrently by up to `max_workers` threads and every `next_page` is
+    followed. Rate limited (429) and failed (5xx) requests are retried with
+    backoff, honoring the `Retry-After` header. When a `CrawlState` is given, the
+    article listings are fetched with `If-None-Match` and the articles whose
+    `updated_at` didn't change since the previous crawl are skipped.
+    """
+
+    def __init__(self, base_url, max_workers=8, max_retries=5, backoff=1.0, timeout=30, state=None, session=None):
+        self.base_url = base_url.rstrip("/")
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.state = state
+        self.requests = 0
+        self.skipped = 0
+        # the ids of the articles listed by the listings of this crawl, changed or not
+        self.listed = set()
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, etag=None):
+        """GETs a url and returns the response, retrying on rate limits, server errors and connection errors."""
+        headers = {"If-None-Match": etag} if etag else {}
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except requests.ConnectionError:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+            self.requests += 1
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt == self.max_retries:
+                    response.raise_for_status()
+                retry_after = response.headers.get("Retry-After")
+                time.sleep(float(retry_after) if retry_after else self.backoff * 2 ** attempt)
+                continue
+            if response.status_code != 304:
+                response.raise_for_status()
+            return response
+
+    def paginate(self, url, key, conditional=False):
+        """Yields the items of a listing, following its `next_page` links.
+
+        With `conditional` and a crawl state, pages that didn't change since the
+        previous crawl are not downloaded again and their items are not yielded."""
+        while url:
+            etag = self.state.etag(url) if conditional and self.state else None
+            response = self.get(url, etag=etag)
+            if response.status_code == 304:
+                self.skipped += 1
+                self.listed.update(self.state.page_ids(url))
+                url = self.state.next_page(url)
+                continue
+            data = response.json()
+            if conditional:
+                ids = [str(item["id"]) for item in data.get(key, [])]
+                self.listed.update(ids)
+                if self.state:
+                    self.state.update_page(url, response.headers.get("ETag"), data.get("next_page"), ids)
+            yield from data.get(key, [])
+            url = data.get("next_page")
+
+    def categories(self):
+        return list(self.paginate(f"{self.base_url}/categories.json", "categories"))
+
+    def sections(self, category):
+        return list(self.paginate(f"{self.base_url}/categories/{category['id']}/sections.json", "sections"))
+
+    def articles(self, section):
+        articles = []
+        for article in self.paginate(f"{self.base_url}/sections/{section['id']}/articles.json", "articles", conditional=True):
+            if self.state and self.state.is_unchanged(article):
+                self.skipped += 1
+                continue
+            articles.append(article)
+        return articles
+
+    def crawl(self):
+        """Yields a (category, section, article) tuple for every (new or changed) article of the help center."""
+        categories = self.categories()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            sections = [(category, section)
+                        for category, category_sections in zip(categories, executor.map(self.sections, categories))
+                        for section in category_sections]
+            for (category, section), articles in zip(sections, executor.map(self.articles, [s for _, s in sections])):
+                for article in articles:
+                    yield category, section, article